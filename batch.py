@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:40:12 2026
+
+@author: rober
+"""
+
+import collections
+import itertools
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import tagging
+
+# The outcome of one item of a batch.
+# index is the position of the item in the input,
+# result is the encoded image, its saved path or the decoded message,
+# and error is the exception raised for the item, if any.
+BatchResult = collections.namedtuple('BatchResult',
+                                     ['index', 'result', 'error'])
+
+def load_image(image):
+    """
+    Return the image, opening it first if it is a path.
+    """
+    if isinstance(image, Image.Image):
+        return image
+    
+    with Image.open(image) as opened:
+        opened.load()
+        return opened
+
+def encode_item(item, block_size):
+    """
+    Encode one (carrier, message) or (carrier, message, out_path) item.
+    
+    The carrier can be a path or an image.
+    If out_path is given, the encoded image is saved there and
+    the path is returned instead of the image.
+    """
+    carrier, message, *out_path = item
+    
+    encoded = tagging.encode_message(load_image(carrier), message, block_size)
+    
+    if out_path:
+        encoded.save(out_path[0])
+        return out_path[0]
+    return encoded
+
+def decode_item(image, block_size):
+    """
+    Decode the message from one image or image path.
+    """
+    return tagging.decode_message(load_image(image), block_size)
+
+def run_chunk(func, chunk, block_size):
+    """
+    Run func over a chunk of (index, item) pairs in a worker.
+    A failure only affects its own item.
+    """
+    results = list()
+    for index, item in chunk:
+        try:
+            results.append(BatchResult(index, func(item, block_size), None))
+        except Exception as e:
+            results.append(BatchResult(index, None, e))
+    return results
+
+def get_chunks(items, chunk_size):
+    """
+    Split the items into lists of (index, item) pairs.
+    """
+    numbered = enumerate(items)
+    while True:
+        chunk = list(itertools.islice(numbered, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def run_batch(func, items, block_size, max_workers, chunk_size):
+    """
+    Run func over the items on a process pool,
+    yielding the results in input order as they are ready.
+    
+    Only a couple of chunks per worker are in flight at a time,
+    so the items can be a long or endless iterable.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_pending = 2 * max_workers
+    
+    with ProcessPoolExecutor(max_workers) as executor:
+        pending = collections.deque()
+        
+        for chunk in get_chunks(items, chunk_size):
+            pending.append(executor.submit(run_chunk, func, chunk, block_size))
+            
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        
+        while pending:
+            yield from pending.popleft().result()
+
+def encode_batch(items, block_size=None, max_workers=None, chunk_size=8):
+    """
+    Encode many messages into many carriers in parallel.
+    
+    Parameters:
+        items: An iterable of (carrier, message) or
+            (carrier, message, out_path) tuples. Passing carriers as paths
+            and giving an out_path keeps the images out of the pickles
+            sent between processes.
+        block_size: The size of the blocks. By default, the largest
+            that fits each message.
+        max_workers: The number of processes. By default, one per core.
+        chunk_size: The number of items sent to a process at a time.
+    
+    Returns:
+        A generator of BatchResult, in the order of the items.
+    """
+    return run_batch(encode_item, items, block_size, max_workers, chunk_size)
+
+def decode_batch(images, block_size=None, max_workers=None, chunk_size=8):
+    """
+    Decode the messages from many images in parallel.
+    
+    Parameters:
+        images: An iterable of images or image paths.
+        block_size: The size of the blocks. By default, it is found
+            from the check bits of each image.
+        max_workers: The number of processes. By default, one per core.
+        chunk_size: The number of images sent to a process at a time.
+    
+    Returns:
+        A generator of BatchResult, in the order of the images.
+    """
+    return run_batch(decode_item, images, block_size, max_workers, chunk_size)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:05:37 2026
+
+@author: rober
+"""
+
+# Benchmarks for steganography and tagging on synthetic carriers.
+#
+# Every case runs in a fresh process so its peak RSS is its own.
+# The results are written as JSON, so runs can be compared over time:
+#
+#     python benchmark.py --output bench.json
+#     python benchmark.py --quick
+
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import string
+import sys
+import time
+
+import numpy as np
+
+from PIL import Image
+
+SIZES = [256, 512, 1024, 2048, 4096, 8192]
+MODES = ['RGB', 'RGBA']
+BLOCK_POWERS = list(range(1, 17))
+FUNCTIONS = ['stega_encode', 'stega_decode',
+             'tagging_encode', 'tagging_decode']
+
+QUICK_SIZES = [256, 1024]
+QUICK_BLOCK_POWERS = [1, 4, 8, 16]
+
+def make_carrier(size, mode, seed=0):
+    """
+    Make a square carrier of random pixels.
+    """
+    rng = np.random.default_rng(seed)
+    depth = len(mode)
+    im_arr = rng.integers(0, 256, (size, size, depth), dtype=np.uint8)
+    return Image.fromarray(im_arr, mode)
+
+def make_bits(num_bits, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 2, num_bits, dtype=np.uint8)
+
+def make_string(carrier, block_size, seed=1):
+    """
+    Make a random lowercase string that nearly fills the carrier.
+    """
+    import steganography as stega
+    import tagging
+    
+    num_bits = stega.capacity(carrier.size, tagging.get_depth(carrier),
+                              block_size)
+    
+    #Leave room for the check bits and the tag
+    length = max(1, (num_bits - tagging.NUM_CHECK_BITS - 128) // 7)
+    
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(string.ascii_lowercase))
+    return ''.join(rng.choice(letters, length))
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    #Linux reports kilobytes, macOS bytes
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+def run_case(case):
+    """
+    Run one benchmark case. This runs in its own process.
+    
+    Parameters:
+        case: A dict with the function, size, mode, block_size and repeat.
+    
+    Returns:
+        dict: The case with its measurements added.
+    """
+    import steganography as stega
+    import tagging
+    
+    func = case['function']
+    block_size = case['block_size']
+    carrier = make_carrier(case['size'], case['mode'])
+    
+    #Set up everything that shouldn't be timed
+    if func.startswith('stega'):
+        num_bits = stega.capacity(carrier.size, tagging.get_depth(carrier),
+                                  block_size)
+        bits = make_bits(num_bits)
+        
+        if func == 'stega_encode':
+            run = lambda: stega.encode_message(carrier, bits, block_size)
+        else:
+            encoded = stega.encode_message(carrier, bits, block_size)
+            run = lambda: stega.decode_message(encoded, block_size)
+    else:
+        message = make_string(carrier, block_size)
+        num_bits = tagging.get_message_length(message)
+        
+        if func == 'tagging_encode':
+            run = lambda: tagging.encode_message(carrier, message, block_size)
+        else:
+            encoded = tagging.encode_message(carrier, message, block_size)
+            run = lambda: tagging.decode_message(encoded)
+    
+    setup_rss = get_peak_rss()
+    
+    times = list()
+    for _ in range(case['repeat']):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    
+    wall_time = min(times)
+    megapixels = case['size'] * case['size'] / 1e6
+    
+    result = dict(case)
+    result.update({'payload_bits': int(num_bits),
+                   'wall_time': wall_time,
+                   'times': times,
+                   'setup_rss': setup_rss,
+                   'peak_rss': get_peak_rss(),
+                   'bits_per_second': num_bits / wall_time,
+                   'megapixels_per_second': megapixels / wall_time})
+    return result
+
+def get_cases(sizes, modes, block_powers, functions, repeat):
+    cases = list()
+    for size in sizes:
+        for mode in modes:
+            for power in block_powers:
+                block_size = 2 ** power
+                
+                #The check bits need a few blocks
+                if size * size * 3 // block_size < 2 * 128 // power:
+                    continue
+                
+                for func in functions:
+                    cases.append({'function': func,
+                                  'size': size,
+                                  'mode': mode,
+                                  'block_size': block_size,
+                                  'repeat': repeat})
+    return cases
+
+def get_metadata():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+def run_benchmarks(cases, log=sys.stderr):
+    """
+    Run every case in a fresh process.
+    
+    Returns:
+        [dict]: The results, in the order of the cases.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = list()
+    
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for i, case in enumerate(cases):
+            result = pool.apply(run_case, (case,))
+            results.append(result)
+            
+            print('[{}/{}] {function} {size} {mode} {block_size}: '
+                  '{wall_time:.4f} s, {peak_rss} B peak'
+                  .format(i + 1, len(cases), **result), file=log)
+    
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark encoding and decoding on synthetic carriers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                        help='Carrier sizes, in pixels per side')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--block-powers', type=int, nargs='+', default=None,
+                        help='Powers of two to use as block sizes')
+    parser.add_argument('--functions', nargs='+', default=FUNCTIONS,
+                        choices=FUNCTIONS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+                        help='Only a few small sizes and block sizes')
+    parser.add_argument('--output', default=None,
+                        help='Where to write the JSON. By default, stdout')
+    args = parser.parse_args()
+    
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    block_powers = args.block_powers or (QUICK_BLOCK_POWERS if args.quick
+                                         else BLOCK_POWERS)
+    
+    cases = get_cases(sizes, args.modes, block_powers, args.functions,
+                      args.repeat)
+    report = {'metadata': get_metadata(),
+              'results': run_benchmarks(cases)}
+    
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1)
+
+if __name__ == '__main__':
+    main()
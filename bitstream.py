@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 12:20:44 2026
+
+@author: rober
+"""
+
+import numpy as np
+
+import conversion as conv
+
+#How many numbers to convert at a time.
+#This is a multiple of eight so every chunk fills whole bytes.
+CHUNK_NUMS = 2**16
+
+class Bitstream:
+    """
+    A sequence of bits, packed eight to a byte, most significant bit first.
+    
+    Slices share the buffer of the stream they come from and keep
+    a bit offset into it, so they don't copy any bits.
+    A stream that shares its buffer copies it before it is appended to.
+    """
+    
+    def __init__(self, data=None, length=0, offset=0, shared=False):
+        """
+        Parameters:
+            data: The packed bits, as a uint8 array.
+            length: The number of bits in the stream.
+            offset: The bit in data where the stream starts.
+            shared: Whether data belongs to something else.
+        """
+        if data is None:
+            data = np.zeros([0], dtype=np.uint8)
+        
+        self.data = data
+        self.length = length
+        self.offset = offset
+        self.shared = shared
+    
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        Make a stream from a list or array of bits.
+        """
+        bits = np.asarray(bits, dtype=np.uint8)
+        return cls(np.packbits(bits), len(bits))
+    
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Make a stream from a bytes-like object, without copying it.
+        """
+        data = np.frombuffer(data, dtype=np.uint8)
+        return cls(data, len(data) * 8, shared=True)
+    
+    @classmethod
+    def from_nums(cls, nums, width):
+        """
+        Make a stream from numbers of width bits each.
+        """
+        nums = np.asarray(nums)
+        
+        chunks = list()
+        for i in range(0, len(nums), CHUNK_NUMS):
+            bits = conv.nums_to_bit_array(nums[i:i+CHUNK_NUMS], width)
+            chunks.append(np.packbits(bits))
+        
+        if not chunks:
+            return cls()
+        return cls(np.concatenate(chunks), len(nums) * width)
+    
+    def __len__(self):
+        return self.length
+    
+    def __repr__(self):
+        return 'Bitstream(length={})'.format(self.length)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            
+            if step != 1:
+                return Bitstream.from_bits(self.to_bits()[key])
+            
+            length = max(0, stop - start)
+            return Bitstream(self.data, length, self.offset + start, True)
+        
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('Bit index out of range')
+        
+        i = self.offset + key
+        return int(self.data[i // 8] >> (7 - i % 8)) & 1
+    
+    def __iter__(self):
+        step = CHUNK_NUMS * 8
+        for start in range(0, self.length, step):
+            yield from self.unpack(start, start + step).tolist()
+    
+    def __eq__(self, other):
+        if not isinstance(other, Bitstream):
+            return NotImplemented
+        return (self.length == other.length
+                and np.array_equal(self.packed(), other.packed()))
+    
+    def __array__(self, dtype=None, copy=None):
+        bits = self.to_bits()
+        if dtype is not None:
+            bits = bits.astype(dtype)
+        return bits
+    
+    def read_num(self, start, width):
+        """
+        Read the width-bit number starting at bit start.
+        
+        Only the bytes holding the number are touched,
+        so this takes the same time anywhere in the stream.
+        """
+        if start < 0 or start + width > self.length:
+            raise IndexError('Read past the end of the bits')
+        
+        first = self.offset + start
+        last = first + width
+        
+        chunk = self.data[first // 8:-(-last // 8)]
+        num = int.from_bytes(chunk.tobytes(), 'big') >> (-last % 8)
+        
+        return num & ((1 << width) - 1)
+    
+    def unpack(self, start=0, stop=None):
+        """
+        Return the bits from start to stop as an array, one bit per byte.
+        """
+        if stop is None or stop > self.length:
+            stop = self.length
+        if stop <= start:
+            return np.zeros([0], dtype=np.uint8)
+        
+        first = self.offset + start
+        last = self.offset + stop
+        
+        bits = np.unpackbits(self.data[first // 8:-(-last // 8)])
+        return bits[first % 8:first % 8 + stop - start]
+    
+    def to_bits(self):
+        """
+        Return all of the bits as an array, one bit per byte.
+        """
+        return self.unpack()
+    
+    def packed(self):
+        """
+        Return the bits packed from the start of a uint8 array,
+        with the unused bits of the last byte set to zero.
+        
+        This is a view of the buffer when the stream starts on a byte.
+        """
+        first = self.offset // 8
+        shift = self.offset % 8
+        num_bytes = -(-self.length // 8)
+        
+        if shift == 0:
+            result = self.data[first:first + num_bytes]
+        else:
+            #Shift every byte over by the offset into the byte
+            window = self.data[first:first + num_bytes + 1]
+            result = np.left_shift(window[:num_bytes], shift)
+            tail = np.right_shift(window[1:num_bytes + 1], 8 - shift)
+            result[:len(tail)] |= tail
+        
+        extra = num_bytes * 8 - self.length
+        if extra and result[-1] & ((1 << extra) - 1):
+            if shift == 0:
+                result = result.copy()
+            result[-1] &= (0xFF << extra) & 0xFF
+        
+        return result
+    
+    def tobytes(self):
+        """
+        Return the bits as bytes, padded with zeros to a whole byte.
+        """
+        return self.packed().tobytes()
+    
+    def to_nums(self, width, count=None):
+        """
+        Group the bits into numbers of width bits, at most 64.
+        
+        Parameters:
+            width: The number of bits in each number.
+            count: The number of numbers. The bits are padded with zeros
+                at the end to fill them. By default, just enough to hold
+                all of the bits.
+        
+        Returns:
+            ndarray: The numbers, as unsigned 64-bit integers.
+        """
+        if count is None:
+            count = -(-self.length // width)
+        
+        nums = list()
+        for i in range(0, count, CHUNK_NUMS):
+            num_chunk = min(CHUNK_NUMS, count - i)
+            
+            bits = self.unpack(i * width, (i + num_chunk) * width)
+            padding = np.zeros([num_chunk * width - len(bits)], dtype=np.uint8)
+            bits = np.concatenate([bits, padding])
+            
+            nums.append(conv.bit_array_to_nums(bits, width))
+        
+        if not nums:
+            return np.zeros([0], dtype=np.uint64)
+        return np.concatenate(nums)
+    
+    def iter_nums(self, width):
+        """
+        Iterate over the bits in numbers of width bits.
+        A short last number is padded with zeros at the end.
+        """
+        step = CHUNK_NUMS * width
+        for start in range(0, self.length, step):
+            yield from self[start:start + step].to_nums(width).tolist()
+    
+    def reserve(self, num_bits):
+        """
+        Make sure the stream owns a buffer, starting at bit zero,
+        with room for num_bits bits.
+        """
+        num_bytes = -(-num_bits // 8) + 1
+        
+        if self.shared or self.offset:
+            data = np.zeros([num_bytes], dtype=np.uint8)
+            packed = self.packed()
+            data[:len(packed)] = packed
+            
+            self.data = data
+            self.offset = 0
+            self.shared = False
+        
+        if len(self.data) < num_bytes:
+            data = np.zeros([max(num_bytes, 2 * len(self.data))],
+                            dtype=np.uint8)
+            data[:len(self.data)] = self.data
+            self.data = data
+    
+    def append(self, bits):
+        """
+        Add bits to the end of the stream.
+        
+        Parameters:
+            bits: A Bitstream, or a list or array of bits.
+        """
+        other = as_bitstream(bits)
+        if not len(other):
+            return
+        
+        self.reserve(self.length + len(other))
+        
+        other_bytes = other.packed()
+        num_bytes = len(other_bytes)
+        first = self.length // 8
+        shift = self.length % 8
+        
+        #The bits past the end of an owned buffer are always zero
+        if shift == 0:
+            self.data[first:first + num_bytes] = other_bytes
+        else:
+            self.data[first:first + num_bytes] |= np.right_shift(other_bytes,
+                                                                 shift)
+            self.data[first + 1:first + num_bytes + 1] |= np.left_shift(
+                other_bytes, 8 - shift)
+        
+        self.length += len(other)
+    
+    def extend(self, bits):
+        self.append(bits)
+
+def as_bitstream(bits):
+    """
+    Return the bits as a Bitstream, converting lists and arrays once.
+    """
+    if isinstance(bits, Bitstream):
+        return bits
+    return Bitstream.from_bits(bits)
+
+def concatenate(streams):
+    """
+    Join the streams into one new stream.
+    """
+    result = Bitstream()
+    result.reserve(sum(len(s) for s in streams))
+    for stream in streams:
+        result.append(stream)
+    return result
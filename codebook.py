@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:02:51 2026
+
+@author: rober
+"""
+
+import collections
+import functools
+import os
+import weakref
+
+import numpy as np
+
+# A codebook lets a block carry more bits than log2(block_size).
+#
+# Every number in a block has an entry, a width-bit string.
+# The syndrome of a block is the xor of the entries of the numbers
+# whose least significant bits are set.
+# The codebook is chosen so that any width-bit difference between
+# the syndrome and the message is the xor of at most max_flips entries,
+# so any message fits in a block by flipping at most max_flips bits.
+#
+# indices holds, for every difference, the entries to flip,
+# padded with NO_INDEX. It can be None, for codebooks too wide
+# to have a table, and then the flips are found with a Solver.
+
+Codebook = collections.namedtuple('Codebook',
+                                  ['entries', 'width', 'max_flips',
+                                   'indices'])
+
+NO_INDEX = 0xFFFF
+
+#About how many numbers to work on at a time
+CHUNK_NUMBERS = 2**20
+
+# A binary table is a header, the entries as little-endian uint64
+# and the indices as a little-endian uint16 matrix
+# with one row of max_flips indices per difference.
+TABLE_MAGIC = b'SCB1'
+TABLE_VERSION = 1
+
+TABLE_HEADER = np.dtype([('magic', 'S4'),
+                         ('version', '<u2'),
+                         ('width', '<u2'),
+                         ('max_flips', '<u2'),
+                         ('reserved', '<u2'),
+                         ('num_entries', '<u4')])
+
+def make_codebook(entries, width, combinations):
+    """
+    Make a codebook from its entries and the combinations to flip.
+    
+    Parameters:
+        entries: The entry of each number in a block.
+        width: The number of bits in each entry.
+        combinations: A dict from every width-bit difference
+            to a list of the indices of the entries that make it.
+    
+    Returns:
+        Codebook: The codebook.
+    """
+    entries = np.asarray(entries, dtype=np.uint64)
+    max_flips = max([len(c) for c in combinations.values()] + [1])
+    
+    indices = np.full((2**width, max_flips), NO_INDEX, dtype=np.uint16)
+    for target, combination in combinations.items():
+        #Flipping the same number twice leaves it as it was
+        counts = collections.Counter(combination)
+        flips = sorted(i for i, c in counts.items() if c % 2)
+        indices[target, :len(flips)] = flips
+    
+    return Codebook(entries, width, max_flips, indices)
+
+def read_text_table(path):
+    """
+    Read a codebook saved by multi_bit_blocks.test.
+    
+    The file has one entry per line as a bitstring, a blank line,
+    then one 'target: [i, j]' line per difference.
+    """
+    with open(path) as table_file:
+        lines = table_file.read().splitlines()
+    
+    blank = lines.index('')
+    entries = [int(line, 2) for line in lines[:blank]]
+    width = len(lines[0])
+    
+    combinations = dict()
+    for line in lines[blank+1:]:
+        if not line:
+            continue
+        target, combination = line.split(':')
+        combination = combination.strip().strip('[]')
+        combinations[int(target, 2)] = [int(i) for i in combination.split(',')
+                                        if i.strip()]
+    
+    if len(combinations) != 2**width:
+        raise ValueError('Table has {} of {} targets'.format(
+            len(combinations), 2**width))
+    
+    return make_codebook(entries, width, combinations)
+
+def write_table(path, codebook):
+    """
+    Save the codebook as a binary table.
+    """
+    if codebook.indices is None:
+        raise ValueError('Codebook has no table')
+    
+    header = np.zeros([1], dtype=TABLE_HEADER)
+    header['magic'] = TABLE_MAGIC
+    header['version'] = TABLE_VERSION
+    header['width'] = codebook.width
+    header['max_flips'] = codebook.max_flips
+    header['num_entries'] = len(codebook.entries)
+    
+    with open(path, 'wb') as table_file:
+        table_file.write(header.tobytes())
+        table_file.write(codebook.entries.astype('<u8').tobytes())
+        table_file.write(codebook.indices.astype('<u2').tobytes())
+
+def read_table(path):
+    """
+    Map a codebook saved by write_table into memory.
+    
+    Nothing is read but the header until the table is used,
+    and the pages are shared between processes.
+    """
+    header = np.fromfile(path, dtype=TABLE_HEADER, count=1)[0]
+    if header['magic'] != TABLE_MAGIC:
+        raise ValueError('Not a codebook table: {}'.format(path))
+    if header['version'] != TABLE_VERSION:
+        raise ValueError('Unknown table version: {}'.format(
+            header['version']))
+    
+    width = int(header['width'])
+    max_flips = int(header['max_flips'])
+    num_entries = int(header['num_entries'])
+    
+    offset = TABLE_HEADER.itemsize
+    entries = np.memmap(path, dtype='<u8', mode='r', offset=offset,
+                        shape=(num_entries,))
+    
+    offset += entries.nbytes
+    indices = np.memmap(path, dtype='<u2', mode='r', offset=offset,
+                        shape=(2**width, max_flips))
+    
+    return Codebook(entries, width, max_flips, indices)
+
+def is_binary_table(path):
+    with open(path, 'rb') as table_file:
+        return table_file.read(len(TABLE_MAGIC)) == TABLE_MAGIC
+
+@functools.lru_cache(maxsize=None)
+def load_path(path):
+    if is_binary_table(path):
+        return read_table(path)
+    return read_text_table(path)
+
+def load(codebook):
+    """
+    Return the codebook, reading it first if it is a path
+    to a binary or text table.
+    
+    Each table is only read once per process.
+    """
+    if isinstance(codebook, Codebook):
+        return codebook
+    return load_path(os.path.abspath(codebook))
+
+def get_block_size(codebook):
+    return len(codebook.entries)
+
+def get_syndromes(codebook, lsbs):
+    """
+    Compute the syndrome of every block.
+    
+    Parameters:
+        codebook: The codebook.
+        lsbs: The least significant bits, one block per row.
+    
+    Returns:
+        ndarray: The syndromes, as unsigned 64-bit integers.
+    """
+    num_blocks = len(lsbs)
+    chunk_blocks = max(1, CHUNK_NUMBERS // get_block_size(codebook))
+    
+    syndromes = np.zeros([num_blocks], dtype=np.uint64)
+    for first in range(0, num_blocks, chunk_blocks):
+        chunk = lsbs[first:first + chunk_blocks].astype(bool)
+        
+        #Xor together the entries of the set bits
+        chosen = np.where(chunk, codebook.entries, np.uint64(0))
+        syndromes[first:first + chunk_blocks] = np.bitwise_xor.reduce(chosen,
+                                                                      axis=1)
+    
+    return syndromes
+
+def get_flips(codebook, diffs):
+    """
+    Find the numbers to flip in every block.
+    
+    Parameters:
+        codebook: The codebook.
+        diffs: The xor of the syndrome and the message of every block.
+    
+    Returns:
+        ndarray: The block of every flip.
+        ndarray: The index of every flip in its block.
+    """
+    if codebook.indices is None:
+        indices, best = get_solver(codebook).solve(diffs)
+        unreachable = np.count_nonzero(best > codebook.max_flips)
+        if unreachable:
+            raise ValueError("Codebook can't reach {} of {} blocks".format(
+                unreachable, len(diffs)))
+    else:
+        indices = codebook.indices[diffs]
+    blocks, flips = np.nonzero(indices != NO_INDEX)
+    
+    return blocks, indices[blocks, flips].astype(np.int64)
+
+# A meet-in-the-middle solver for the entries to flip.
+#
+# Any combination of up to max_flips entries splits into a left half
+# of up to ceil(max_flips/2) entries and a right half of the rest.
+# The xors of every left half are sorted, so for each right half
+# the left half that completes a target is found by a binary search,
+# for a whole batch of targets at once.
+
+#The widest codebook whose left halves are looked up in a dense array
+DENSE_WIDTH = 24
+
+def get_combinations(entries, size):
+    """
+    Find the xor of every combination of up to size entries.
+    
+    Returns:
+        ndarray: The xors.
+        ndarray: The indices of the entries of each combination,
+            padded with NO_INDEX.
+        ndarray: The number of entries in each combination.
+    """
+    num_entries = len(entries)
+    
+    xors = [np.zeros([1], dtype=np.uint64)]
+    indices = [np.full((1, size), NO_INDEX, dtype=np.uint16)]
+    counts = [np.zeros([1], dtype=np.uint8)]
+    
+    last_xors = xors[0]
+    last_indices = indices[0]
+    for count in range(1, size + 1):
+        new_xors = list()
+        new_indices = list()
+        
+        #Extend every combination with a later entry
+        last = last_indices[:, count - 2] if count > 1 else None
+        for i in range(num_entries):
+            if last is None:
+                rows = np.arange(len(last_xors))
+            else:
+                rows = np.flatnonzero(last < i)
+            
+            combination = last_indices[rows].copy()
+            combination[:, count - 1] = i
+            new_xors.append(last_xors[rows] ^ entries[i])
+            new_indices.append(combination)
+        
+        if not new_xors:
+            break
+        last_xors = np.concatenate(new_xors)
+        last_indices = np.concatenate(new_indices)
+        
+        xors.append(last_xors)
+        indices.append(last_indices)
+        counts.append(np.full([len(last_xors)], count, dtype=np.uint8))
+    
+    return np.concatenate(xors), np.concatenate(indices), np.concatenate(counts)
+
+def get_fewest(xors, indices, counts):
+    """
+    Sort the combinations by xor, keeping the one with the fewest
+    entries for each xor.
+    """
+    #Combinations are in order of size, so a stable sort
+    #puts the smallest first
+    order = np.argsort(xors, kind='stable')
+    xors = xors[order]
+    
+    first = np.ones([len(xors)], dtype=bool)
+    first[1:] = xors[1:] != xors[:-1]
+    order = order[first]
+    
+    return xors[first], indices[order], counts[order]
+
+class Solver:
+    """
+    Find the fewest entries that xor to each of a batch of targets.
+    """
+    
+    def __init__(self, entries, max_flips):
+        """
+        Parameters:
+            entries: The entries of the codebook.
+            max_flips: The most entries to xor together.
+        """
+        entries = np.asarray(entries, dtype=np.uint64)
+        self.max_flips = max_flips
+        
+        left = get_combinations(entries, -(-max_flips // 2))
+        self.left_xors, self.left_indices, self.left_counts = get_fewest(
+            *left)
+        
+        right = get_combinations(entries, max_flips // 2)
+        self.right_xors, self.right_indices, self.right_counts = get_fewest(
+            *right)
+        
+        #Try the smallest right halves first
+        order = np.argsort(self.right_counts, kind='stable')
+        self.right_xors = self.right_xors[order]
+        self.right_indices = self.right_indices[order]
+        self.right_counts = self.right_counts[order]
+        
+        #Narrow codebooks look the left halves up directly
+        width = int(entries.max(initial=0)).bit_length()
+        self.left_at = None
+        if width <= DENSE_WIDTH:
+            self.left_at = np.full([2**width], -1, dtype=np.int32)
+            self.left_at[self.left_xors.astype(np.int64)] = np.arange(
+                len(self.left_xors))
+    
+    def join(self, left, right):
+        """
+        Join the left and right halves into rows of indices,
+        sorted with the padding last.
+        """
+        indices = np.concatenate([self.left_indices[left],
+                                  self.right_indices[right]], axis=1)
+        return np.sort(indices, axis=1)[:, :self.max_flips]
+    
+    def solve(self, targets):
+        """
+        Find the fewest entries that xor to each target.
+        
+        Parameters:
+            targets: The targets.
+        
+        Returns:
+            ndarray: The indices of the entries for each target,
+                padded with NO_INDEX.
+            ndarray: The number of entries for each target,
+                or max_flips + 1 if it can't be reached.
+        """
+        targets = np.asarray(targets, dtype=np.uint64)
+        
+        best = np.full([len(targets)], self.max_flips + 1, dtype=np.uint8)
+        left = np.zeros([len(targets)], dtype=np.int64)
+        right = np.zeros([len(targets)], dtype=np.int64)
+        
+        #Going through the right halves from the smallest,
+        #the first match for a target has the fewest flips
+        active = np.arange(len(targets))
+        for j, right_xor in enumerate(self.right_xors):
+            active = active[best[active] > self.max_flips]
+            if not len(active):
+                break
+            
+            wanted = targets[active] ^ right_xor
+            if self.left_at is None:
+                positions = np.searchsorted(self.left_xors, wanted)
+                positions[positions == len(self.left_xors)] = 0
+                found = self.left_xors[positions] == wanted
+            else:
+                #Targets wider than the entries can't be reached
+                wanted = wanted.astype(np.int64)
+                inside = wanted < len(self.left_at)
+                positions = np.full([len(wanted)], -1, dtype=np.int64)
+                positions[inside] = self.left_at[wanted[inside]]
+                found = positions >= 0
+            
+            positions = positions[found]
+            best[active[found]] = self.left_counts[positions] + (
+                self.right_counts[j])
+            left[active[found]] = positions
+            right[active[found]] = j
+        
+        indices = self.join(left, right)
+        indices[best > self.max_flips] = NO_INDEX
+        return indices, best
+    
+    def solve_all(self, width):
+        """
+        Find the fewest entries that xor to every width-bit target,
+        by going through every pair of halves once.
+        
+        Returns:
+            ndarray: The indices of the entries for each target,
+                padded with NO_INDEX.
+            ndarray: The number of entries for each target,
+                or max_flips + 1 if it can't be reached.
+        """
+        size = 2**width
+        
+        best = np.full([size], self.max_flips + 1, dtype=np.uint8)
+        left = np.zeros([size], dtype=np.int64)
+        right = np.zeros([size], dtype=np.int64)
+        
+        positions = np.arange(len(self.left_xors))
+        for j, right_xor in enumerate(self.right_xors):
+            targets = (self.left_xors ^ right_xor).astype(np.int64)
+            counts = self.left_counts + self.right_counts[j]
+            
+            #Xors wider than the targets aren't targets
+            inside = targets < size
+            targets = targets[inside]
+            counts = counts[inside]
+            
+            better = counts < best[targets]
+            found = targets[better]
+            best[found] = counts[better]
+            left[found] = positions[inside][better]
+            right[found] = j
+        
+        indices = self.join(left, right)
+        indices[best > self.max_flips] = NO_INDEX
+        return indices, best
+    
+    def reachable(self, width):
+        """
+        Return which width-bit targets can be reached.
+        """
+        _, best = self.solve_all(width)
+        return best <= self.max_flips
+
+#The solver of each codebook, by the id of its entries and its max_flips.
+#A solver is dropped when its entries are.
+SOLVERS = dict()
+
+def get_solver(codebook):
+    key = (id(codebook.entries), codebook.max_flips)
+    if key not in SOLVERS:
+        SOLVERS[key] = Solver(codebook.entries, codebook.max_flips)
+        weakref.finalize(codebook.entries, SOLVERS.pop, key, None)
+    return SOLVERS[key]
+
+def validate(codebook):
+    """
+    Check that every target of the codebook can be reached
+    and that its table xors to each target with at most max_flips flips.
+    
+    Returns:
+        bool: Whether the codebook is valid.
+    """
+    solver = get_solver(codebook)
+    _, best = solver.solve_all(codebook.width)
+    if (best > codebook.max_flips).any():
+        return False
+    
+    if codebook.indices is None:
+        return True
+    
+    #The table doesn't have to have the fewest flips, just few enough
+    entries = np.append(np.asarray(codebook.entries, dtype=np.uint64),
+                        np.uint64(0))
+    indices = np.asarray(codebook.indices, dtype=np.int64)
+    indices[indices == NO_INDEX] = len(entries) - 1
+    
+    xors = np.bitwise_xor.reduce(entries[indices], axis=1)
+    counts = np.count_nonzero(codebook.indices != NO_INDEX, axis=1)
+    
+    return (np.array_equal(xors, np.arange(2**codebook.width, dtype=np.uint64))
+            and (counts <= codebook.max_flips).all())
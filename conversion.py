@@ -5,8 +5,6 @@ Created on Fri Apr 30 20:31:51 2021
 @author: rober
 """
 
-import math
-
 import numpy as np
 
 from PIL import Image
@@ -18,23 +16,127 @@ def add_alpha(im_arr, value):
     
     return np.concatenate([im_arr, alpha], axis=2)
 
-def bits_to_num(bits):
-    bits = [str(b) for b in bits]
+def get_powers(width):
+    """
+    Return the powers of two for a width-bit number,
+    from most significant to least.
+    """
+    if width > 64:
+        raise ValueError('Width too big: {}'.format(width))
+    return np.left_shift(np.uint64(1), np.arange(width - 1, -1, -1,
+                                                 dtype=np.uint64))
+
+def nums_to_bit_array(nums, width):
+    """
+    Convert an array of numbers into a matrix of bits.
+    
+    Parameters:
+        nums: The numbers to convert.
+        width: The number of bits to use for each number, at most 64.
+    
+    Returns:
+        ndarray: The bits of each number along the last axis,
+            from most significant to least.
+    """
+    nums = np.asarray(nums).astype(np.uint64)
+    shifts = np.arange(width - 1, -1, -1, dtype=np.uint64)
+    
+    bits = np.right_shift(nums[..., np.newaxis], shifts)
+    return np.bitwise_and(bits, 1).astype(np.uint8)
+
+def bit_array_to_nums(bits, width=6):
+    """
+    Convert a 1-D array of bits into an array of numbers.
+    
+    A short last group is read as a number of its own length.
+    
+    Parameters:
+        bits: The bits to convert, most significant bit first.
+        width: The number of bits in each number, at most 64.
+    
+    Returns:
+        ndarray: The numbers, as unsigned 64-bit integers.
+    """
+    bits = np.asarray(bits, dtype=np.uint8)
+    num_full = len(bits) // width
+    
+    full = np.reshape(bits[:num_full * width], (num_full, width))
+    nums = np.dot(full, get_powers(width))
     
-    return int(''.join(bits), 2)
+    rest = bits[num_full * width:]
+    if len(rest) > 0:
+        last = np.dot(rest, get_powers(len(rest)))
+        nums = np.append(nums, np.uint64(last))
+    
+    return nums
+
+def num_to_bit_array(num, width=None):
+    """
+    Return the bits in the number, from most significant to least,
+    as an array. The number can be any size.
+    """
+    num = int(num)
+    if width is None:
+        width = get_width(num)
+    
+    num %= 2 ** width
+    num_bytes = (width + 7) // 8
+    
+    as_bytes = np.frombuffer(num.to_bytes(num_bytes, 'big'), dtype=np.uint8)
+    bits = np.unpackbits(as_bytes)
+    return bits[len(bits) - width:]
+
+def bit_array_to_num(bits):
+    """
+    Convert an array of bits, most significant first, into a number.
+    The number can be any size.
+    """
+    bits = np.asarray(bits, dtype=np.uint8)
+    
+    #Pad the front so the bits fill whole bytes
+    padding = np.zeros([-len(bits) % 8], dtype=np.uint8)
+    bits = np.concatenate([padding, bits])
+    
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def str_to_nums(s):
+    """
+    Return the array of the code points of the characters in the string.
+    """
+    return np.frombuffer(s.encode('utf-32-le'), dtype='<u4')
+
+def str_to_bit_array(s, width=7):
+    """
+    Convert a string into a 1-D array of bits, width bits per character.
+    """
+    codes = str_to_nums(s)
+    return np.reshape(nums_to_bit_array(codes, width), [len(codes) * width])
+
+def nums_to_str(nums):
+    """
+    Convert an array of code points into a string.
+    """
+    codes = np.asarray(nums).astype('<u4')
+    return codes.tobytes().decode('utf-32-le', 'surrogatepass')
+
+def bit_array_to_str(bits, width=7):
+    """
+    Convert a 1-D array of bits into a string, width bits per character.
+    """
+    return nums_to_str(bit_array_to_nums(bits, width))
+
+def bits_to_num(bits):
+    return bit_array_to_num(bits)
 
 def bits_to_nums(bits, width=6):
     """
     Convert a list of bits into a list of numbers.
     """
-    result = list()
-    for i in range(0, len(bits), width):
-        chunk = list(bits[i:i+width])
-        chunk = [str(i) for i in chunk]
-        
-        num = int(''.join(chunk), 2)
-        result.append(num)
-    return result
+    if width > 64:
+        return [bits_to_num(bits[i:i+width])
+                for i in range(0, len(bits), width)]
+    
+    return bit_array_to_nums(bits, width).tolist()
 
 def get_width(num):
     """
@@ -46,48 +148,26 @@ def get_width(num):
     Return:
         int: The width of the number in bits.
     """
-    return math.ceil(math.log(num+1, 2))
+    return int(num).bit_length()
 
 def get_bits(num, width=None):
     """
     Return the bits in the number, from most significant to least.
     """
-    if width is None:
-        width = get_width(num)
-    # print(width)
-    
-    result = list()
-    for _ in range(width):
-        result.append(num % 2)
-        num //= 2
-    return result[::-1]
+    return num_to_bit_array(num, width).tolist()
 
 def str_to_bits(s, width=7):
-    result = list()
-    for char in s:
-        num = ord(char)
-        bits = get_bits(num, width=width)
-        result.extend(bits)
-    return result
+    return str_to_bit_array(s, width).tolist()
 
 def bits_to_str(bits, width=7):
     """
     Convert a list of bits into a string.
     """
-    result = list()
-    for i in range(0, len(bits), width):
-        chunk = list(bits[i:i+width])
-        chunk = [str(i) for i in chunk]
-        
-        num = int(''.join(chunk), 2)
-        
-        result.append(chr(num))
-        
-    return ''.join(result)
+    return bit_array_to_str(bits, width)
 
-def image_to_bits(image, ignore_last_channel=True):
+def image_to_bytes(image, ignore_last_channel=True):
     """
-    Convert an image into a 1-D array of bits.
+    Convert an image into a 1-D array of its bytes.
     """
     im_arr = np.asarray(image)
     w, h, d = im_arr.shape
@@ -98,11 +178,13 @@ def image_to_bits(image, ignore_last_channel=True):
         im_arr = im_arr[:, :, :d]
     
     #Flatten the image into a list of numbers
-    flattened = np.reshape(im_arr, w*h*d)
-    
-    into_bits = np.unpackbits(flattened)
-    
-    return into_bits
+    return np.reshape(im_arr, w*h*d)
+
+def image_to_bits(image, ignore_last_channel=True):
+    """
+    Convert an image into a 1-D array of bits.
+    """
+    return np.unpackbits(image_to_bytes(image, ignore_last_channel))
 
 def bits_to_image(bits, shape, add_last_channel=True):
     """
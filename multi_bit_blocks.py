@@ -6,7 +6,13 @@ Created on Tue Apr 27 12:56:21 2021
 """
 
 import math
-import itertools
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import codebook as cb
 
 def convert(num, base, width):
     #Represent a number in the given base, 1 < base <= 2
@@ -35,30 +41,18 @@ def get_choices(block_size, num_bits, num_groups):
 def find_choice(choices, num_bits, target):
     #Find a selection of numbers from choices
     #whose xor equals the target numbers
-    for order in range(num_bits+1):
-        for comb in itertools.combinations_with_replacement(choices, order):
-            result = 0
-            for num in comb:
-                result ^= num
-            if result == target:
-                return comb
-    return None
+    indices, counts = cb.Solver(choices, num_bits).solve([target])
+    if counts[0] > num_bits:
+        return None
+    return tuple(choices[i] for i in indices[0] if i != cb.NO_INDEX)
 
 def get_num_successful(choices, num, max_target, num_groups):
-    possibilities = 0
-    for i in range(max_target):
-        if find_choice(choices, num, i) is not None:
-            possibilities += 1
-        else:
-            pass
-            # print(convert(i, 2, num_groups))
-    return possibilities
+    solver = cb.Solver(choices, num)
+    _, counts = solver.solve(np.arange(max_target))
+    return int(np.count_nonzero(counts <= num))
 
 def works(choices, num, max_target):
-    for i in range(max_target):
-        if find_choice(choices, num, i) is None:
-            return False
-    return True
+    return get_num_successful(choices, num, max_target, None) == max_target
 
 #For using as a key in a dict
 def bitstring_combination(bitstrings):
@@ -154,7 +148,7 @@ def make_bitstrings(string_len, num_strings, num_choices, i=5):
             xors[total_len][total_comb] = total_xor
             if not total_xor in found:
                 found[total_xor] = total_comb
-        
+    
     return bitstrings, found
 
 def test():
@@ -194,8 +188,376 @@ def test():
                 c_indices.sort()
                 save_file.write('{}: {}\n'.format(convert(target, 2, num_groups), c_indices))
 
+# A faster search for codebooks.
+#
+# Instead of dicts of combinations, the targets that can be reached
+# by xoring up to j entries are kept as a bitmap over every target,
+# one per j, along with the list of reached targets of each bitmap.
+# Adding an entry e xors every reached target with e,
+# so a candidate is scored by looking up all of the reached targets
+# (or all of the holes) xored with it at once.
+#
+# The bitmaps and lists live in one buffer, which can be
+# shared memory so candidates can be scored on other processes.
+
+#The state of the search in a worker process
+SEARCH_STATE = None
+
+def get_search_arrays(buffer, width, max_flips):
+    """
+    Lay out the bitmaps, the reached targets and the holes in a buffer.
+    """
+    size = 2**width
+    levels = max_flips + 1
+    
+    reached = np.ndarray((levels, size), dtype=bool, buffer=buffer)
+    members = np.ndarray((levels, size), dtype=np.uint32, buffer=buffer,
+                         offset=levels * size)
+    holes = np.ndarray((size,), dtype=np.uint32, buffer=buffer,
+                       offset=5 * levels * size)
+    return reached, members, holes
+
+def get_search_bytes(width, max_flips):
+    return (5 * (max_flips + 1) + 4) * 2**width
+
+def attach_search(name, width, max_flips):
+    """
+    Attach a worker process to the shared search state.
+    """
+    global SEARCH_STATE
+    memory = shared_memory.SharedMemory(name)
+    SEARCH_STATE = (memory,) + get_search_arrays(memory.buf, width, max_flips)
+
+def score_candidates(reached, members, holes, num_members, num_holes,
+                     candidates):
+    """
+    Count how many new targets each candidate makes reachable
+    with the most flips.
+    
+    Parameters:
+        reached: The bitmaps of reachable targets.
+        members: The reached targets of each bitmap.
+        holes: The targets that can't be reached yet.
+        num_members: The number of reached targets with one flip less.
+        num_holes: The number of holes.
+        candidates: The entries to score.
+    
+    Returns:
+        [int]: The number of new targets for each candidate.
+    """
+    top = len(reached) - 1
+    below = members[top - 1, :num_members]
+    holes = holes[:num_holes]
+    
+    gains = list()
+    for candidate in candidates:
+        candidate = np.uint32(candidate)
+        
+        #Look from whichever side is smaller
+        if num_members < num_holes:
+            gain = np.count_nonzero(~reached[top][below ^ candidate])
+        else:
+            gain = np.count_nonzero(reached[top - 1][holes ^ candidate])
+        gains.append(int(gain))
+    
+    return gains
+
+def score_shared(num_members, num_holes, candidates):
+    _, reached, members, holes = SEARCH_STATE
+    return score_candidates(reached, members, holes, num_members, num_holes,
+                            candidates)
+
+class CodebookSearch:
+    """
+    Greedily pick entries that make as many new targets reachable
+    as possible.
+    """
+    
+    def __init__(self, width, max_flips, workers=1):
+        """
+        Parameters:
+            width: The number of bits in each entry.
+            max_flips: The most entries xored together.
+            workers: The number of processes to score candidates with.
+        """
+        self.width = width
+        self.max_flips = max_flips
+        self.workers = workers
+        
+        num_bytes = get_search_bytes(width, max_flips)
+        if workers > 1:
+            self.memory = shared_memory.SharedMemory(create=True,
+                                                     size=num_bytes)
+            buffer = self.memory.buf
+        else:
+            self.memory = None
+            buffer = bytearray(num_bytes)
+        
+        arrays = get_search_arrays(buffer, width, max_flips)
+        self.reached, self.members, self.holes = arrays
+        
+        #Only zero can be reached without flips
+        self.reached[:] = False
+        self.reached[:, 0] = True
+        self.members[:, 0] = 0
+        self.num_members = [1] * (max_flips + 1)
+        
+        self.holes[:] = np.arange(2**width, dtype=np.uint32)
+        self.holes[0] = self.holes[-1]
+        self.num_holes = 2**width - 1
+        self.num_filled = 0
+        
+        self.executor = None
+        if workers > 1:
+            self.executor = ProcessPoolExecutor(
+                workers, initializer=attach_search,
+                initargs=(self.memory.name, width, max_flips))
+        
+        self.entries = list()
+    
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.memory is not None:
+            self.reached = self.members = self.holes = None
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def compact_holes(self):
+        holes = self.holes[:self.num_holes]
+        holes = holes[~self.reached[self.max_flips][holes]]
+        self.holes[:len(holes)] = holes
+        self.num_holes = len(holes)
+        self.num_filled = 0
+    
+    def score(self, candidates):
+        num_members = self.num_members[self.max_flips - 1]
+        
+        #Scoring from the holes needs them all to be holes
+        if self.num_filled and self.num_holes <= num_members:
+            self.compact_holes()
+        
+        if self.executor is None:
+            return score_candidates(self.reached, self.members, self.holes,
+                                    num_members, self.num_holes, candidates)
+        
+        chunks = np.array_split(np.asarray(candidates), self.workers)
+        futures = [self.executor.submit(score_shared, num_members,
+                                        self.num_holes, chunk.tolist())
+                   for chunk in chunks if len(chunk)]
+        return [gain for future in futures for gain in future.result()]
+    
+    def add(self, entry):
+        """
+        Add an entry, updating the reachable targets.
+        """
+        entry = np.uint32(entry)
+        num_reached = self.num_members[self.max_flips]
+        
+        #Go down so each level is extended with the old level below it
+        for j in range(self.max_flips, 0, -1):
+            targets = self.members[j - 1, :self.num_members[j - 1]] ^ entry
+            new = targets[~self.reached[j][targets]]
+            
+            self.reached[j][new] = True
+            self.members[j, self.num_members[j]:
+                         self.num_members[j] + len(new)] = new
+            self.num_members[j] += len(new)
+        
+        #Drop the filled holes once enough of them have been filled
+        self.num_filled += self.num_members[self.max_flips] - num_reached
+        if self.num_filled * 4 >= self.num_holes:
+            self.compact_holes()
+        
+        self.entries.append(int(entry))
+    
+    def search(self, num_strings, tries=16, rng=None):
+        """
+        Pick num_strings entries, each the best of tries random ones
+        that fill a hole.
+        
+        Returns:
+            [int]: The entries.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        
+        while len(self.entries) < num_strings:
+            #Once everything can be reached, any entry will do
+            if self.num_holes == self.num_filled:
+                self.add(rng.integers(1, 2**self.width))
+                continue
+            
+            #Every candidate fills at least one hole:
+            #a hole xored with a target reachable with a flip less
+            top = self.max_flips - 1
+            holes = self.holes[rng.integers(0, self.num_holes, tries)]
+            members = self.members[top, rng.integers(0, self.num_members[top],
+                                                     tries)]
+            candidates = holes ^ members
+            
+            gains = self.score(candidates.tolist())
+            self.add(candidates[int(np.argmax(gains))])
+        
+        return self.entries
+
+def build_indices(entries, width, max_flips):
+    """
+    Find the fewest entries that xor to each target, going out
+    one flip at a time from the targets already found.
+    
+    Returns:
+        ndarray: The indices of the entries for each target,
+            padded with cb.NO_INDEX.
+        ndarray: The number of flips for each target,
+            or max_flips + 1 if it can't be reached.
+    """
+    size = 2**width
+    entries = np.asarray(entries, dtype=np.int64)
+    
+    indices = np.full((size, max_flips), cb.NO_INDEX, dtype=np.uint16)
+    flips = np.full([size], max_flips + 1, dtype=np.uint8)
+    flips[0] = 0
+    
+    frontier = np.zeros([1], dtype=np.int64)
+    for j in range(1, max_flips + 1):
+        holes = np.flatnonzero(flips > j)
+        
+        for i, entry in enumerate(entries):
+            #Go out from the frontier or in from the holes,
+            #whichever is smaller
+            if len(frontier) <= len(holes):
+                targets = frontier ^ entry
+                found = flips[targets] > j
+                sources = frontier[found]
+                targets = targets[found]
+            else:
+                if not len(holes):
+                    break
+                sources = holes ^ entry
+                found = flips[sources] == j - 1
+                sources = sources[found]
+                targets = holes[found]
+                holes = holes[~found]
+            
+            indices[targets, :j-1] = indices[sources, :j-1]
+            indices[targets, j-1] = i
+            flips[targets] = j
+        
+        frontier = np.flatnonzero(flips == j)
+    
+    return indices, flips
+
+#The widest entries a table is made for.
+#The table has 2**width rows of max_flips uint16 indices.
+MAX_WIDTH = 24
+
+def default_width(block_size, max_flips):
+    width = math.floor(math.log(math.comb(block_size, max_flips), 2))
+    return min(width, MAX_WIDTH)
+
+def search_codebook(block_size, max_flips, width, tries=16, workers=1,
+                    rng=None):
+    """
+    Search for a codebook with entries of the given width.
+    
+    Returns:
+        Codebook: The codebook, or None if some targets can't be reached.
+        int: The number of targets that can't be reached.
+    """
+    with CodebookSearch(width, max_flips, workers) as search:
+        entries = search.search(block_size, tries, rng)
+        num_holes = search.num_holes - search.num_filled
+    
+    if num_holes:
+        return None, num_holes
+    
+    indices, _ = build_indices(entries, width, max_flips)
+    return cb.Codebook(np.array(entries, dtype=np.uint64), width, max_flips,
+                       indices), 0
+
+def generate_codebook(block_size, max_flips, width=None, tries=16,
+                      workers=1, seed=None, unreachable=None):
+    """
+    Search for a codebook where every target is reachable.
+    
+    Parameters:
+        block_size: The number of entries.
+        max_flips: The most entries xored together.
+        width: The number of bits in each entry. By default, the widest
+            that works, starting from floor(log2(block_size choose
+            max_flips)) like test, up to MAX_WIDTH.
+        tries: The number of random candidates for each entry.
+        workers: The number of processes to score candidates with.
+        seed: The seed of the random candidates.
+        unreachable: A dict to fill in with the number of targets
+            that can't be reached at each width tried.
+    
+    Returns:
+        Codebook: The codebook, or None if some targets can't be reached.
+    """
+    if block_size > cb.NO_INDEX:
+        raise ValueError('Block size too big: {}'.format(block_size))
+    
+    rng = np.random.default_rng(seed)
+    
+    if width is None:
+        widths = range(default_width(block_size, max_flips), 0, -1)
+    else:
+        widths = [width]
+    
+    for width in widths:
+        codebook, num_holes = search_codebook(block_size, max_flips, width,
+                                              tries, workers, rng)
+        if unreachable is not None:
+            unreachable[width] = num_holes
+        if codebook is not None:
+            return codebook
+    
+    return None
+
 def main():
-    test()
+    import argparse
+    
+    parser = argparse.ArgumentParser(
+        description='Search for a codebook and save it as a binary table')
+    parser.add_argument('block_size', type=int, nargs='?', default=None)
+    parser.add_argument('max_flips', type=int, nargs='?', default=2)
+    parser.add_argument('--width', type=int, default=None)
+    parser.add_argument('--tries', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+    
+    #The old search
+    if args.block_size is None:
+        test()
+        return
+    
+    unreachable = dict()
+    codebook = generate_codebook(args.block_size, args.max_flips,
+                                 args.width, args.tries, args.workers,
+                                 args.seed, unreachable)
+    for width, num_holes in unreachable.items():
+        print('Width {}: {} of {} targets unreachable'.format(width, num_holes,
+                                                              2**width))
+    if codebook is None:
+        return
+    
+    output = args.output
+    if output is None:
+        output = 'bitstrings/bitstrings_{}_choose_{}.bin'.format(
+            args.block_size, args.max_flips)
+    cb.write_table(output, codebook)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
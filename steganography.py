@@ -7,174 +7,1083 @@ Created on Mon Apr 26 14:52:58 2021
 
 import math
 
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 from IPython.display import display
 from PIL import Image
 
+import bitstream
+import codebook as cb
 import conversion as conv
 import tagging
 
-def image_to_blocks(im_arr, block_size):
-    im, ih, depth = im_arr.shape
-    num_pixels = im*ih
+#The parity of every possible byte
+BYTE_PARITY = np.array([bin(i).count('1') % 2 for i in range(256)],
+                       dtype=np.uint8)
+
+#For each of the low three bits of an index,
+#the mask over a packed byte of the bits whose index has that bit set
+INDEX_BIT_MASKS = [sum(1 << (7 - r) for r in range(8) if (r >> p) % 2)
+                   for p in range(3)]
+
+#The fewest numbers worth handing to another thread
+MIN_SHARD_SIZE = 2**18
+
+def get_bits_per_block(block_size):
+    """
+    Return the number of message bits carried by each block.
+    """
+    if block_size < 2 or block_size & (block_size - 1):
+        raise ValueError('Block size must be a power of two')
+    return block_size.bit_length() - 1
+
+def get_syndrome_dtype(block_size):
+    """
+    Return the smallest unsigned type that holds any index in a block.
+    """
+    bits_per_block = get_bits_per_block(block_size)
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if bits_per_block <= np.iinfo(dtype).bits:
+            return dtype
+    return np.uint64
+
+def get_syndromes(bits, block_size):
+    """
+    Return the XOR of the indices of the set bits in each block.
     
-    num_numbers = num_pixels * depth
-    num_blocks = num_numbers // block_size
+    Bit p of a block's syndrome is the parity of the block's bits
+    whose index has bit p set, so it is read off the packed bits
+    with byte masks instead of multiplying by an array of indices.
+    
+    Parameters:
+        bits: The least significant bits, in blocks of block_size.
+        block_size: The size of the blocks.
+    
+    Returns:
+        ndarray: The syndrome of each block.
+    """
+    bits_per_block = get_bits_per_block(block_size)
+    dtype = get_syndrome_dtype(block_size)
+    
+    bits = np.reshape(bits, (-1, block_size))
+    packed = np.packbits(bits, axis=1)
+    num_blocks, _ = packed.shape
+    
+    syndromes = np.zeros([num_blocks], dtype=dtype)
+    
+    #The low three bits of an index pick the bit inside a byte
+    all_bytes = np.bitwise_xor.reduce(packed, axis=1)
+    for p in range(min(3, bits_per_block)):
+        parity = BYTE_PARITY[all_bytes & INDEX_BIT_MASKS[p]]
+        syndromes |= np.left_shift(parity.astype(dtype), p)
+    
+    #The rest of the bits pick the byte
+    for p in range(3, bits_per_block):
+        step = 2 ** (p - 3)
+        grouped = np.reshape(packed, (num_blocks, -1, 2, step))
+        set_bytes = np.bitwise_xor.reduce(grouped[:, :, 1, :], axis=(1, 2))
+        parity = BYTE_PARITY[set_bytes]
+        syndromes |= np.left_shift(parity.astype(dtype), p)
+    
+    return syndromes
+
+def get_shards(num_blocks, block_size, workers):
+    """
+    Split the blocks into at most one contiguous shard per worker,
+    none of them smaller than MIN_SHARD_SIZE numbers.
+    
+    Returns:
+        [(int, int)]: The first and last block of each shard.
+    """
+    num_shards = num_blocks * block_size // MIN_SHARD_SIZE
+    num_shards = max(1, min(workers, num_shards))
+    
+    bounds = [num_blocks * i // num_shards for i in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def get_lsb_syndromes(numbers, block_size, workers=1):
+    """
+    Return the syndrome of each block of the given numbers.
+    
+    With more than one worker, the blocks are split into shards
+    that run on a thread pool. NumPy releases the GIL while it
+    works on each shard, so they run at the same time.
+    
+    Parameters:
+        numbers: The numbers, in blocks of block_size.
+        block_size: The size of the blocks.
+        workers: The number of threads to use.
+    
+    Returns:
+        ndarray: The syndrome of each block.
+    """
+    blocks = np.reshape(numbers, (-1, block_size))
+    num_blocks, _ = blocks.shape
+    
+    def shard_syndromes(shard):
+        first, last = shard
+        return get_syndromes(np.bitwise_and(blocks[first:last], 1),
+                             block_size)
+    
+    shards = get_shards(num_blocks, block_size, workers)
+    if len(shards) == 1:
+        return shard_syndromes(shards[0])
+    
+    with ThreadPoolExecutor(len(shards)) as executor:
+        return np.concatenate(list(executor.map(shard_syndromes, shards)))
+
+def remove_alpha(im_arr):
+    _, _, d = im_arr.shape
+    return im_arr[:, :, :d-1]
+
+def get_carrier_array(image):
+    """
+    Return the array of the numbers in the image that carry the message.
+    
+    The alpha channel of an RGBA image is left out with a view,
+    not a copy.
+    """
+    im_arr = np.asarray(image)
+    
+    #Ignore alpha channel
+    if image.mode == 'RGBA':
+        im_arr = remove_alpha(im_arr)
+    
+    return im_arr
+
+def get_num_blocks(im_arr, block_size):
+    """
+    Return the number of whole blocks in the image array.
+    """
+    num_blocks = im_arr.size // block_size
     
     if num_blocks <= 0:
         raise ValueError('Block size too big')
     
-    used_numbers = num_blocks * block_size
+    return num_blocks
+
+def get_numbers(im_arr, start, stop):
+    """
+    Return the numbers from start to stop of the flattened image array.
     
-    #Flatten the image
-    flat = np.reshape(im_arr, [num_numbers])
+    Only the rows holding those numbers are copied, and only if
+    the array isn't contiguous, like a view without its alpha channel
+    or a buffer with padded rows.
+    """
+    _, width, depth = im_arr.shape
+    row_numbers = width * depth
     
-    #Get rid of the unused bits
-    truncated = flat[:used_numbers]
+    first = start // row_numbers
+    last = -(-stop // row_numbers)
+    numbers = np.reshape(im_arr[first:last], (last - first) * row_numbers)
     
-    #Group the chunks together
-    chunked = np.reshape(truncated, (num_blocks, block_size))
+    return numbers[start - first * row_numbers:stop - first * row_numbers]
+
+def flip_lsbs(im_arr, positions):
+    """
+    Flip the least significant bit of the numbers at the given positions,
+    in place.
     
-    #Get the bits
-    bits = np.mod(chunked, 2)
+    The positions index the flattened image, so strided views
+    (like an RGBA image without its alpha channel) are written through
+    without being copied.
+    """
+    index = np.unravel_index(positions, im_arr.shape)
+    im_arr[index] ^= 1
+
+def clear_lsbs(im_arr, start, stop):
+    """
+    Wipe out the least significant bit of the numbers from start to stop
+    of the flattened image array, in place.
+    """
+    index = np.unravel_index(np.arange(start, stop), im_arr.shape)
+    im_arr[index] &= 0xFE
+
+def change_lsbs(im_arr, positions, reference):
+    """
+    Change the least significant bit of the numbers at the given positions
+    by adding or subtracting one, whichever moves them toward
+    the reference, in place.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        positions: The positions in the flattened array.
+        reference: The values the numbers should be close to,
+            in the same shape as im_arr.
+    """
+    index = np.unravel_index(positions, im_arr.shape)
+    numbers = im_arr[index]
     
-    return bits
+    im_arr[index] = get_changed(numbers, reference[index])
 
-def blocks_to_image(bits, width, height, depth):
+def get_changed(numbers, reference):
     """
-    Convert the given bits to an image with values only in the least
-    significant bits.
+    Return the numbers moved by one toward the reference,
+    staying in the range of their type.
     """
-    num_blocks, block_size = bits.shape
-    num_numbers = width * height * depth
+    #Compare as signed numbers, so neither side can wrap around
+    signed = numbers.astype(np.int64)
+    up = np.asarray(reference, dtype=np.float64) > signed
+    up[numbers == 0] = True
+    up[numbers == np.iinfo(numbers.dtype).max] = False
     
-    #Flatten and extend the bits
-    num_bits = num_blocks * block_size
-    flat_bits = np.reshape(bits, num_bits)
+    return np.where(up, signed + 1, signed - 1)
+
+def get_texture_costs(im_arr):
+    """
+    Return the cost of changing each number of the image array.
     
-    extend = num_numbers - num_bits
-    extend_bits = np.zeros([extend], dtype=np.uint8)
-    flat_bits = np.concatenate([flat_bits, extend_bits])
+    Changes are cheap in busy parts of the image and expensive in flat
+    parts, so the cost is one over one plus the differences
+    from the four neighbouring pixels.
+    """
+    numbers = im_arr.astype(np.float32)
+    padded = np.pad(numbers, ((1, 1), (1, 1), (0, 0)), mode='edge')
     
-    #Reshape the bits into the shape of an image
-    im_arr = np.reshape(flat_bits, [width, height, depth])
+    texture = (np.abs(numbers - padded[:-2, 1:-1])
+               + np.abs(numbers - padded[2:, 1:-1])
+               + np.abs(numbers - padded[1:-1, :-2])
+               + np.abs(numbers - padded[1:-1, 2:]))
     
-    return im_arr
+    return 1 / (1 + texture)
 
-def get_chunk_nums(im_bits, num_blocks, block_size):
+def get_costs(im_arr, costs='texture', reference=None):
     """
-    Return the array with the XOR of the active bits in each block.
+    Return the cost map to encode with.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        costs: 'texture' for get_texture_costs, or an array
+            of costs in the same shape as im_arr.
+        reference: The values the numbers should be close to.
+            A change toward the reference costs nothing
+            and a change away from it costs double.
+    
+    Returns:
+        ndarray: The costs.
     """
-    count = get_count_array(num_blocks, block_size)
-    prod = np.multiply(im_bits, count)
-    chunk_nums = np.bitwise_xor.reduce(prod, axis=1)
-    return chunk_nums
+    if isinstance(costs, str):
+        if costs != 'texture':
+            raise ValueError('Unknown costs: {}'.format(costs))
+        costs = get_texture_costs(im_arr)
+    costs = np.asarray(costs, dtype=np.float32)
+    
+    if reference is not None:
+        #Subtract as floats, so unsigned numbers can't wrap around
+        reference = np.asarray(reference, dtype=np.float32)
+        changed = get_changed(im_arr, reference).astype(np.float32)
+        error = np.abs(im_arr.astype(np.float32) - reference)
+        costs = costs * (1 + np.abs(changed - reference) - error)
+    
+    return costs
 
-def get_count_array(num_blocks, block_size):
+def choose_flips(diffs, costs):
     """
-    Return the count array.
+    Choose the cheapest numbers to flip in every block.
+    
+    A block with a difference d can flip the number at d,
+    or any pair a and a ^ d, and one with no difference flips nothing.
+    
+    Parameters:
+        diffs: The xor of the syndrome and the message of every block.
+        costs: The cost of flipping each number, one block per row.
+    
+    Returns:
+        ndarray: The block of every flip.
+        ndarray: The index of every flip in its block.
     """
-    count = np.arange(start=0, stop=block_size)
-    count = np.stack([count]*num_blocks, axis=0)
-    return count
+    num_blocks, block_size = costs.shape
+    chunk_blocks = max(1, MIN_SHARD_SIZE // block_size)
+    diffs = diffs.astype(np.int64)
+    
+    blocks = list()
+    flips = list()
+    for first in range(0, num_blocks, chunk_blocks):
+        chunk_diffs = diffs[first:first + chunk_blocks]
+        chunk_costs = costs[first:first + chunk_blocks]
+        rows = np.arange(len(chunk_diffs))
+        
+        #The cost of every pair, with a = 0 and a = d left out
+        partners = np.arange(block_size) ^ chunk_diffs[:, None]
+        pair_costs = chunk_costs + chunk_costs[rows[:, None], partners]
+        pair_costs[:, 0] = np.inf
+        pair_costs[rows, chunk_diffs] = np.inf
+        
+        pairs = np.argmin(pair_costs, axis=1)
+        use_pair = (pair_costs[rows, pairs] < chunk_costs[rows, chunk_diffs])
+        use_pair &= chunk_diffs != 0
+        use_single = ~use_pair & (chunk_diffs != 0)
+        
+        blocks += [first + rows[use_single],
+                   first + rows[use_pair],
+                   first + rows[use_pair]]
+        flips += [chunk_diffs[use_single],
+                  pairs[use_pair],
+                  pairs[use_pair] ^ chunk_diffs[use_pair]]
+    
+    if not blocks:
+        return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+    return np.concatenate(blocks), np.concatenate(flips)
 
-def expand_message_bits(message_bits, block_size, num_blocks):
-    bits_per_block = round(math.log(block_size, 2))
+def embed_blocks(im_arr, message_bits, block_size, first_block=0,
+                 num_blocks=None, offset=0, workers=1, costs=None,
+                 reference=None, syndromes=None):
+    """
+    Encode the message bits into consecutive blocks of the given
+    writable image array, in place.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        message_bits: The bits to encode, as a Bitstream or a list
+            or array. They are padded with zeros to fill the blocks.
+        block_size: The size of the blocks.
+        first_block: The block to start encoding into.
+        num_blocks: The number of blocks to encode into.
+            By default, just enough to hold the message bits.
+        offset: Where block zero starts in the flattened array.
+        workers: The number of threads to compute the syndromes with.
+        costs: The cost of changing each number, in the same shape
+            as im_arr. If given, each block makes its cheapest change
+            instead of always flipping the number at its difference.
+        reference: The values the numbers should be close to.
+            If given, numbers are changed by one toward them
+            instead of having their lowest bit flipped.
+        syndromes: The syndromes of the blocks, if they are already known.
+    """
+    bits_per_block = get_bits_per_block(block_size)
+    message_bits = bitstream.as_bitstream(message_bits)
+    
+    if num_blocks is None:
+        num_blocks = -(-len(message_bits) // bits_per_block)
+    
+    start = offset + first_block * block_size
+    stop = start + num_blocks * block_size
+    if stop > im_arr.size:
+        raise ValueError('Not enough blocks: {}'.format(num_blocks))
+    
+    if syndromes is None:
+        numbers = get_numbers(im_arr, start, stop)
+        chunk_nums = get_lsb_syndromes(numbers, block_size, workers)
+    else:
+        chunk_nums = syndromes
+    
     num_bits = num_blocks * bits_per_block
-    expansion = num_bits - len(message_bits)
+    if len(message_bits) > num_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            len(message_bits), num_bits))
     
-    if expansion < 0:
-        print('Message too long: {} - {}'.format(len(message_bits), num_bits))
-        raise ValueError()
+    #Combine the message bits into chunks, padding the end with zeros
+    message_nums = message_bits.to_nums(bits_per_block, num_blocks)
+    message_nums = message_nums.astype(chunk_nums.dtype)
     
-    message_bits = list(message_bits)
-    message_bits = message_bits + ([0] * expansion)
-    return message_bits
+    diffs = np.bitwise_xor(chunk_nums, message_nums)
+    apply_diffs(im_arr, diffs, block_size, start, costs, reference)
 
-def remove_alpha(im_arr):
-    _, _, d = im_arr.shape
-    return im_arr[:, :, :d-1]
+def apply_diffs(im_arr, diffs, block_size, start=0, costs=None,
+                reference=None):
+    """
+    Change the image array so the syndromes of consecutive blocks
+    are xored with the given differences, in place.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        diffs: The difference for each block.
+        block_size: The size of the blocks.
+        start: Where the first block starts in the flattened array.
+        costs: The cost of changing each number, as in embed_blocks.
+        reference: The values the numbers should be close to,
+            as in embed_blocks.
+    """
+    num_blocks = len(diffs)
+    
+    if costs is None:
+        #Twiddle the chosen bit in every block at once
+        positions = start + np.arange(num_blocks) * block_size + diffs
+    else:
+        block_costs = get_numbers(costs, start,
+                                  start + num_blocks * block_size)
+        block_costs = np.reshape(block_costs, (num_blocks, block_size))
+        
+        blocks, flips = choose_flips(diffs, block_costs)
+        positions = start + blocks * block_size + flips
+    
+    if reference is None:
+        flip_lsbs(im_arr, positions)
+    else:
+        change_lsbs(im_arr, positions, reference)
 
-def encode_message(image, message_bits, block_size=64):
+def extract_blocks(im_arr, block_size, first_block=0, num_blocks=None,
+                   offset=0, workers=1):
     """
-    Encode the message bits into the given image.
+    Decode the bits from consecutive blocks of the given image array.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        block_size: The size of the blocks.
+        first_block: The block to start decoding from.
+        num_blocks: The number of blocks to decode.
+            By default, all of the remaining blocks.
+        offset: Where block zero starts in the flattened array.
+        workers: The number of threads to compute the syndromes with.
+    
+    Returns:
+        Bitstream: The decoded bits.
     """
-    has_alpha = image.mode == 'RGBA'
+    bits_per_block = get_bits_per_block(block_size)
     
-    im_arr = np.asarray(image)
-    width, height, depth = im_arr.shape
+    if num_blocks is None:
+        num_blocks = get_num_blocks(im_arr, block_size) - first_block
+    
+    start = offset + first_block * block_size
+    stop = start + num_blocks * block_size
+    if stop > im_arr.size:
+        raise ValueError('Not enough blocks: {}'.format(num_blocks))
+    
+    numbers = get_numbers(im_arr, start, stop)
+    ors = get_lsb_syndromes(numbers, block_size, workers)
+    
+    return bitstream.Bitstream.from_nums(ors, bits_per_block)
+
+def get_band_blocks(num_blocks, block_size, band_size=None):
+    """
+    Split the blocks into bands of about band_size numbers each.
+    
+    Returns:
+        [(int, int)]: The first block and number of blocks in each band.
+    """
+    if band_size is None:
+        return [(0, num_blocks)]
+    
+    band_blocks = max(1, band_size // block_size)
+    return [(first, min(band_blocks, num_blocks - first))
+            for first in range(0, num_blocks, band_blocks)]
+
+def embed_in_place(im_arr, message_bits, block_size=64, band_size=None,
+                   workers=1, costs=None, reference=None, prefix_only=False,
+                   syndromes=None):
+    """
+    Encode the message bits into the given writable image array, in place.
+    
+    The array should only contain the channels that carry the message.
+    It can be a view, like a np.memmap with its alpha channel sliced off.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        message_bits: The bits to encode.
+        block_size: The size of the blocks.
+        band_size: About how many numbers to work on at a time.
+            By default, the whole array at once.
+        workers: The number of threads to compute the syndromes with.
+        costs: The cost of changing each number, as in embed_blocks.
+        reference: The values the numbers should be close to,
+            as in embed_blocks.
+        prefix_only: Whether to only touch the blocks the message bits
+            need, leaving the rest of the array as it is,
+            instead of padding the message with zeros to fill it.
+        syndromes: The syndromes of every block of the array,
+            if they are already known.
+    """
+    num_blocks = get_num_blocks(im_arr, block_size)
+    bits_per_block = get_bits_per_block(block_size)
+    
+    num_bits = num_blocks * bits_per_block
+    if len(message_bits) > num_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            len(message_bits), num_bits))
+    
+    #Convert once, so the bands are views of the same bits
+    message_bits = bitstream.as_bitstream(message_bits)
+    
+    if prefix_only:
+        num_blocks = -(-len(message_bits) // bits_per_block)
+    
+    for first, band_blocks in get_band_blocks(num_blocks, block_size,
+                                              band_size):
+        band_bits = message_bits[first * bits_per_block:
+                                 (first + band_blocks) * bits_per_block]
+        band_syndromes = None
+        if syndromes is not None:
+            band_syndromes = syndromes[first:first + band_blocks]
+        
+        embed_blocks(im_arr, band_bits, block_size, first, band_blocks,
+                     workers=workers, costs=costs, reference=reference,
+                     syndromes=band_syndromes)
+    
+    #The numbers past the last block get their low order bits wiped out
+    if not prefix_only:
+        clear_lsbs(im_arr, num_blocks * block_size, im_arr.size)
+
+def extract_in_place(im_arr, block_size=64, band_size=None, workers=1):
+    """
+    Decode the bits from the given image array without copying it.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        block_size: The size of the blocks.
+        band_size: About how many numbers to work on at a time.
+            By default, the whole array at once.
+        workers: The number of threads to compute the syndromes with.
+    
+    Returns:
+        Bitstream: The decoded bits.
+    """
+    num_blocks = get_num_blocks(im_arr, block_size)
+    
+    bits = [extract_blocks(im_arr, block_size, first, band_blocks,
+                           workers=workers)
+            for first, band_blocks in get_band_blocks(num_blocks, block_size,
+                                                      band_size)]
+    return bitstream.concatenate(bits)
+
+def iter_extract(im_arr, block_size=64, chunk_bits=2**16, first_block=0,
+                 workers=1, grow=False):
+    """
+    Decode the bits from the given image array a range of blocks at a time,
+    so a caller can stop once it has all it needs.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        block_size: The size of the blocks.
+        chunk_bits: About how many bits to decode at a time.
+        first_block: The block to start decoding from.
+        workers: The number of threads to compute the syndromes with.
+        grow: Whether each range should be as big as all of the ones
+            before it, for when the caller doesn't know how much it needs.
+    
+    Yields:
+        Bitstream: The bits of each range of whole blocks.
+    """
+    num_blocks = get_num_blocks(im_arr, block_size)
+    chunk_blocks = -(-chunk_bits // get_bits_per_block(block_size))
+    
+    first = first_block
+    while first < num_blocks:
+        count = min(chunk_blocks, num_blocks - first)
+        yield extract_blocks(im_arr, block_size, first, count,
+                             workers=workers)
+        
+        first += count
+        if grow:
+            chunk_blocks = first - first_block
+
+def open_raw_carrier(path, shape, dtype=np.uint8, mode='r+', offset=0,
+                     has_alpha=False):
+    """
+    Memory-map a raw, uncompressed carrier file.
+    
+    Parameters:
+        path: The file holding the pixels, row by row.
+        shape: The (height, width, depth) of the carrier.
+        dtype: The type of each number.
+        mode: The np.memmap mode. 'r' is enough to decode.
+        offset: Where the pixels start in the file.
+        has_alpha: Whether the last channel is an alpha channel.
+    
+    Returns:
+        np.memmap: The numbers that carry the message.
+            The alpha channel is skipped with strides, not copied.
+    """
+    im_arr = np.memmap(path, dtype=dtype, mode=mode, offset=offset,
+                       shape=tuple(shape))
     
-    #Ignore alpha channel
     if has_alpha:
-        depth -= 1
         im_arr = remove_alpha(im_arr)
     
-    im_bits = image_to_blocks(im_arr, block_size=block_size)
-    num_blocks, _ = im_bits.shape
+    return im_arr
+
+def as_carrier_array(buffer, shape, dtype=np.uint8, offset=0, strides=None,
+                     has_alpha=False):
+    """
+    Wrap a raw carrier buffer in an array without copying it.
+    
+    Parameters:
+        buffer: Any object with the buffer protocol, like a bytearray,
+            an mmap or a shared memory block. It must be writable to encode.
+        shape: The (height, width, depth) of the carrier.
+        dtype: The type of each number.
+        offset: Where the pixels start in the buffer.
+        strides: The strides of the pixels, if they are not packed.
+        has_alpha: Whether the last channel is an alpha channel.
+    
+    Returns:
+        ndarray: The numbers that carry the message.
+    """
+    im_arr = np.ndarray(tuple(shape), dtype=dtype, buffer=buffer,
+                        offset=offset, strides=strides)
     
-    chunk_nums = get_chunk_nums(im_bits, num_blocks, block_size)
+    if has_alpha:
+        im_arr = remove_alpha(im_arr)
     
-    # #Expand the message bits to the same number of bits
-    message_bits = expand_message_bits(message_bits, block_size, num_blocks)
+    return im_arr
+
+def encode_raw(im_arr, message_bits, block_size=64, band_size=2**24,
+               workers=1):
+    """
+    Encode the message bits into a raw carrier from open_raw_carrier
+    or as_carrier_array, in place and one band at a time.
     
-    #Also combine the message bits into chunks
-    bits_per_block = round(math.log(block_size, 2))
-    message_nums = conv.bits_to_nums(message_bits, width=bits_per_block)
-    message_nums = np.array(message_nums)
+    Unlike encode_message, the alpha channel is left as it is.
+    """
+    embed_in_place(im_arr, message_bits, block_size, band_size, workers)
     
-    diffs = np.bitwise_xor(chunk_nums, message_nums)
+    if isinstance(im_arr, np.memmap):
+        im_arr.flush()
+
+def decode_raw(im_arr, block_size=64, band_size=2**24, workers=1):
+    """
+    Decode the message from a raw carrier from open_raw_carrier
+    or as_carrier_array, one band at a time.
+    """
+    return extract_in_place(im_arr, block_size, band_size, workers)
+
+def capacity(carrier_size, depth, block_size):
+    """
+    Return the number of message bits a carrier holds.
     
-    #Twiddle the bits in im_bits to make the right output
-    for i in range(num_blocks):
-        diff = diffs[i]
-        im_bits[i, diff] = 1 - im_bits[i, diff]
+    Parameters:
+        carrier_size: The (width, height) of the carrier, like Image.size.
+        depth: The number of channels that carry the message.
+        block_size: The size of the blocks.
+    
+    Returns:
+        int: The number of bits.
+    """
+    width, height = carrier_size
+    num_blocks = width * height * depth // block_size
     
-    #Now the bits have been changed,
-    #Reshape them into an image and combine them with the given image
-    message_image = blocks_to_image(im_bits, width, height, depth)
+    return num_blocks * get_bits_per_block(block_size)
+
+def encode_message(image, message_bits, block_size=64, workers=1,
+                   costs=None, reference=None, prefix_only=False):
+    """
+    Encode the message bits into the given image.
     
-    #Wipe out the low order bits
-    im_arr = im_arr - np.mod(im_arr, 2)
+    The syndromes are computed with the given number of threads.
     
-    #Add the new low order bits
-    im_arr[:, :, 0:depth] += message_image
+    By default, each block flips the number at its difference.
+    With costs, each block makes its cheapest change instead:
+    costs can be 'texture', to avoid flat parts of the image,
+    or an array of costs in the shape of the channels that carry
+    the message. With a reference array in that shape, like the image
+    before it was quantized, numbers are changed by one toward it,
+    and the costs are 'texture' unless given.
     
-    # #Add alpha back in
-    if has_alpha:
-        im_arr = conv.add_alpha(im_arr, 255)
+    With prefix_only, only the blocks the message bits need are touched
+    and the rest of the image, alpha channel included, is left as it is.
+    This is for messages that know their own length, like tagged ones.
+    """
+    #Check the message fits before touching any pixels
+    num_bits = capacity(image.size, tagging.get_depth(image), block_size)
+    if len(message_bits) > num_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            len(message_bits), num_bits))
+    
+    #Copy the image so the bits can be written straight into it
+    im_arr = np.array(image)
+    embed_image_array(im_arr, image.mode == 'RGBA', message_bits, block_size,
+                      workers, costs, reference, prefix_only)
     
     return Image.fromarray(im_arr)
 
-def decode_message(image, block_size=64):
+def embed_image_array(im_arr, has_alpha, message_bits, block_size=64,
+                      workers=1, costs=None, reference=None,
+                      prefix_only=False, syndromes=None):
+    """
+    Encode the message bits into a writable copy of an image's array,
+    in place, like encode_message.
+    
+    Parameters:
+        im_arr: The numbers of the image, alpha channel included.
+        has_alpha: Whether the last channel is an alpha channel.
+        syndromes: The syndromes of every block of the channels that
+            carry the message, if they are already known.
+    """
+    #Ignore alpha channel
+    if has_alpha:
+        if not prefix_only:
+            im_arr[:, :, -1] = 255
+        carrier = remove_alpha(im_arr)
+    else:
+        carrier = im_arr
+    
+    if costs is not None or reference is not None:
+        costs = get_costs(carrier, 'texture' if costs is None else costs,
+                          reference)
+    
+    embed_in_place(carrier, message_bits, block_size, workers=workers,
+                   costs=costs, reference=reference, prefix_only=prefix_only,
+                   syndromes=syndromes)
+
+def decode_message(image, block_size=64, workers=1):
     """
     Decode the message from the given image.
+    
+    The syndromes are computed with the given number of threads.
     """
-    im_arr = np.asarray(image)
+    return extract_blocks(get_carrier_array(image), block_size,
+                          workers=workers)
+
+class PreparedCarrier:
+    """
+    A carrier for encoding many messages into, one at a time.
+    
+    The pixels are copied once, and the syndromes of all of the blocks
+    are computed once for each block size, so encoding a message
+    is only a copy of the pixels and the flips.
+    """
+    
+    def __init__(self, image, max_block_sizes=4, workers=1):
+        """
+        Parameters:
+            image: The carrier image.
+            max_block_sizes: How many block sizes to keep the syndromes of.
+                The least recently used are dropped first.
+            workers: The number of threads to compute the syndromes with.
+        """
+        self.mode = image.mode
+        self.size = image.size
+        self.has_alpha = image.mode == 'RGBA'
+        self.depth = tagging.get_depth(image)
+        
+        self.base = np.array(image)
+        self.base.flags.writeable = False
+        
+        self.max_block_sizes = max_block_sizes
+        self.workers = workers
+        self.syndromes = collections.OrderedDict()
+    
+    def get_carrier(self, im_arr):
+        if self.has_alpha:
+            return remove_alpha(im_arr)
+        return im_arr
+    
+    def get_syndromes(self, block_size):
+        """
+        Return the syndrome of every block of the carrier,
+        computing it the first time.
+        """
+        if block_size in self.syndromes:
+            self.syndromes.move_to_end(block_size)
+            return self.syndromes[block_size]
+        
+        carrier = self.get_carrier(self.base)
+        num_blocks = get_num_blocks(carrier, block_size)
+        numbers = get_numbers(carrier, 0, num_blocks * block_size)
+        
+        syndromes = get_lsb_syndromes(numbers, block_size, self.workers)
+        self.syndromes[block_size] = syndromes
+        
+        while len(self.syndromes) > self.max_block_sizes:
+            self.syndromes.popitem(last=False)
+        
+        return syndromes
+    
+    def encode(self, message_bits, block_size=64, costs=None,
+               reference=None, prefix_only=False):
+        """
+        Encode the message bits into a copy of the carrier,
+        like encode_message.
+        
+        Returns:
+            Image: The carrier with the message.
+        """
+        im_arr = self.base.copy()
+        embed_image_array(im_arr, self.has_alpha, message_bits, block_size,
+                          self.workers, costs, reference, prefix_only,
+                          self.get_syndromes(block_size))
+        
+        return Image.fromarray(im_arr)
+
+def multi_bit_capacity(carrier_size, depth, codebook):
+    """
+    Return the number of message bits a carrier holds with a codebook.
+    
+    The codebook can be a Codebook or the path of a codebook table.
+    """
+    codebook = cb.load(codebook)
+    width, height = carrier_size
+    num_blocks = width * height * depth // cb.get_block_size(codebook)
+    
+    return num_blocks * codebook.width
+
+def embed_codebook_blocks(im_arr, message_bits, codebook, first_block=0,
+                          num_blocks=None):
+    """
+    Encode the message bits into consecutive blocks of the given
+    writable image array, in place, with a codebook.
+    
+    Every block carries codebook.width bits
+    with at most codebook.max_flips changes.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        message_bits: The bits to encode. They are padded with zeros
+            to fill the blocks.
+        codebook: The Codebook to encode with.
+        first_block: The block to start encoding into.
+        num_blocks: The number of blocks to encode into.
+            By default, just enough to hold the message bits.
+    """
+    block_size = cb.get_block_size(codebook)
+    message_bits = bitstream.as_bitstream(message_bits)
+    
+    if num_blocks is None:
+        num_blocks = -(-len(message_bits) // codebook.width)
+    
+    start = first_block * block_size
+    stop = start + num_blocks * block_size
+    if stop > im_arr.size:
+        raise ValueError('Not enough blocks: {}'.format(num_blocks))
+    
+    num_bits = num_blocks * codebook.width
+    if len(message_bits) > num_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            len(message_bits), num_bits))
+    
+    numbers = get_numbers(im_arr, start, stop)
+    lsbs = np.reshape(numbers & 1, (num_blocks, block_size))
+    syndromes = cb.get_syndromes(codebook, lsbs)
+    
+    message_nums = message_bits.to_nums(codebook.width, num_blocks)
+    diffs = np.bitwise_xor(syndromes, message_nums)
+    
+    #Look up the numbers to flip in every block at once
+    blocks, flips = cb.get_flips(codebook, diffs)
+    flip_lsbs(im_arr, start + blocks * block_size + flips)
+
+def extract_codebook_blocks(im_arr, codebook, first_block=0, num_blocks=None):
+    """
+    Decode the bits from consecutive blocks of the given image array
+    with a codebook.
+    
+    Returns:
+        Bitstream: The decoded bits.
+    """
+    block_size = cb.get_block_size(codebook)
+    
+    if num_blocks is None:
+        num_blocks = im_arr.size // block_size - first_block
+    
+    start = first_block * block_size
+    stop = start + num_blocks * block_size
+    if stop > im_arr.size:
+        raise ValueError('Not enough blocks: {}'.format(num_blocks))
+    
+    numbers = get_numbers(im_arr, start, stop)
+    lsbs = np.reshape(numbers & 1, (num_blocks, block_size))
+    syndromes = cb.get_syndromes(codebook, lsbs)
+    
+    return bitstream.Bitstream.from_nums(syndromes, codebook.width)
+
+def encode_multi_bit(image, message_bits, codebook):
+    """
+    Encode the message bits into the given image with a codebook,
+    like encode_message but with more bits per change.
+    
+    Parameters:
+        image: The carrier.
+        message_bits: The bits to encode.
+        codebook: A Codebook or the path of a codebook table.
+    
+    Returns:
+        Image: The carrier with the message.
+    """
+    codebook = cb.load(codebook)
+    block_size = cb.get_block_size(codebook)
+    
+    num_bits = multi_bit_capacity(image.size, tagging.get_depth(image),
+                                  codebook)
+    if len(message_bits) > num_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            len(message_bits), num_bits))
     
     has_alpha = image.mode == 'RGBA'
+    im_arr = np.array(image)
     
     #Ignore alpha channel
     if has_alpha:
-        im_arr = remove_alpha(im_arr)
+        im_arr[:, :, -1] = 255
+        carrier = remove_alpha(im_arr)
+    else:
+        carrier = im_arr
     
-    bits = image_to_blocks(im_arr, block_size=block_size)
-    num_blocks, _ = bits.shape
+    num_blocks = carrier.size // block_size
+    embed_codebook_blocks(carrier, message_bits, codebook, 0, num_blocks)
     
-    #The counting array
-    count = get_count_array(num_blocks, block_size)
+    #The numbers past the last block get their low order bits wiped out
+    clear_lsbs(carrier, num_blocks * block_size, carrier.size)
     
-    #Do the operation
-    prod = np.multiply(bits, count)
+    return Image.fromarray(im_arr)
+
+def decode_multi_bit(image, codebook):
+    """
+    Decode the message from the given image with a codebook.
     
-    ors = np.bitwise_xor.reduce(prod, axis=1)
+    Parameters:
+        image: The image with the message.
+        codebook: A Codebook or the path of a codebook table.
     
-    bits_per_block = round(math.log(block_size, 2))
-    bits = list()
-    for i in range(ors.shape[0]):
-        bits.extend(conv.get_bits(ors[i], bits_per_block))
+    Returns:
+        Bitstream: The decoded bits.
+    """
+    codebook = cb.load(codebook)
+    return extract_codebook_blocks(get_carrier_array(image), codebook)
+
+def iter_decode(image, block_size=64, chunk_bits=2**16, workers=1):
+    """
+    Decode the message from the given image a range of blocks at a time.
     
-    return bits
+    Yields:
+        Bitstream: The bits of each range of blocks.
+    """
+    return iter_extract(get_carrier_array(image), block_size, chunk_bits,
+                        workers=workers)
+
+def get_band_numbers(im_arr, block_size, band_rows):
+    """
+    Return how many numbers go in each band of a tiled encode or decode:
+    the whole blocks that fit in band_rows rows, and at least one block.
+    """
+    _, width, depth = im_arr.shape
+    band_blocks = max(1, band_rows * width * depth // block_size)
+    return band_blocks * block_size
+
+def get_band(source, row_numbers, start, stop, carry=None):
+    """
+    Copy the rows of the source holding the numbers from start to stop.
+    
+    Returns:
+        int: The first row of the band.
+        ndarray: The rows. The first one is replaced by carry if given.
+    """
+    first_row = start // row_numbers
+    last_row = -(-stop // row_numbers)
+    
+    band = np.array(source[first_row:last_row])
+    if carry is not None:
+        band[0] = carry
+    
+    return first_row, band
+
+def encode_tiled(source, message_bits, block_size=64, dest=None,
+                 band_rows=256, has_alpha=False):
+    """
+    Encode the message bits into a carrier one band of rows at a time.
+    
+    Only one band is held in memory, so the carrier can be a np.memmap
+    or any other array that is read and written by row slices.
+    The result is the same as encode_message.
+    
+    Parameters:
+        source: The (height, width, depth) carrier.
+        message_bits: The bits to encode.
+        block_size: The size of the blocks.
+        dest: Where the encoded rows are written. By default,
+            back into the source.
+        band_rows: About how many rows go in each band.
+        has_alpha: Whether the last channel is an alpha channel.
+    """
+    if dest is None:
+        dest = source
+    
+    height, width, depth = source.shape
+    if has_alpha:
+        depth -= 1
+    
+    row_numbers = width * depth
+    num_numbers = height * row_numbers
+    num_blocks = num_numbers // block_size
+    
+    if num_blocks <= 0:
+        raise ValueError('Block size too big')
+    
+    bits_per_block = get_bits_per_block(block_size)
+    num_bits = num_blocks * bits_per_block
+    if len(message_bits) > num_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            len(message_bits), num_bits))
+    
+    message_bits = bitstream.as_bitstream(message_bits)
+    band_numbers = get_band_numbers(source[:1, :, :depth], block_size,
+                                    band_rows)
+    used_numbers = num_blocks * block_size
+    
+    #The bands cover the blocks, then whatever is past the last block.
+    #A row shared by two bands is carried over with its changes.
+    bounds = list(range(0, used_numbers, band_numbers)) + [used_numbers]
+    if used_numbers < num_numbers:
+        bounds.append(num_numbers)
+    
+    carry = None
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        first_row, band = get_band(source, row_numbers, start, stop, carry)
+        
+        if has_alpha:
+            band[:, :, -1] = 255
+        
+        data = band[:, :, :depth]
+        offset = first_row * row_numbers
+        
+        if start < used_numbers:
+            first_block = start // block_size
+            band_blocks = (stop - start) // block_size
+            
+            band_bits = message_bits[first_block * bits_per_block:
+                                     (first_block + band_blocks) * bits_per_block]
+            
+            embed_blocks(data, band_bits, block_size, first_block,
+                         band_blocks, -offset)
+        else:
+            clear_lsbs(data, start - offset, stop - offset)
+        
+        dest[first_row:first_row + len(band)] = band
+        carry = band[-1] if stop % row_numbers else None
+    
+    if hasattr(dest, 'flush'):
+        dest.flush()
+
+def decode_tiled(source, block_size=64, band_rows=256, has_alpha=False):
+    """
+    Decode the message from a carrier one band of rows at a time.
+    
+    Parameters:
+        source: The (height, width, depth) carrier.
+        block_size: The size of the blocks.
+        band_rows: About how many rows go in each band.
+        has_alpha: Whether the last channel is an alpha channel.
+    
+    Returns:
+        Bitstream: The decoded bits, the same as decode_message.
+    """
+    height, width, depth = source.shape
+    if has_alpha:
+        depth -= 1
+    
+    row_numbers = width * depth
+    num_blocks = height * row_numbers // block_size
+    
+    if num_blocks <= 0:
+        raise ValueError('Block size too big')
+    
+    band_numbers = get_band_numbers(source[:1, :, :depth], block_size,
+                                    band_rows)
+    used_numbers = num_blocks * block_size
+    
+    bits = list()
+    for start in range(0, used_numbers, band_numbers):
+        stop = min(start + band_numbers, used_numbers)
+        first_row, band = get_band(source, row_numbers, start, stop)
+        offset = first_row * row_numbers
+        
+        bits.append(extract_blocks(band[:, :, :depth], block_size,
+                                   start // block_size,
+                                   (stop - start) // block_size, -offset))
+    
+    return bitstream.concatenate(bits)
 
 def least_bit(image):
     im_arr = np.asarray(image)
@@ -316,7 +1225,283 @@ def new_decode_test():
     elif isinstance(message, Image.Image):
         display(message)
 
+def slow_encode(im_arr, message_bits, block_size, has_alpha=False):
+    """
+    Encode the message bits one block at a time, like the original
+    encode_message, to check the faster ways of encoding against.
+    """
+    _, _, depth = im_arr.shape
+    if has_alpha:
+        depth -= 1
+    
+    numbers = im_arr[:, :, :depth].flatten()
+    lsbs = numbers % 2
+    
+    bits_per_block = get_bits_per_block(block_size)
+    num_blocks = len(numbers) // block_size
+    
+    message_bits = list(message_bits)
+    message_bits += [0] * (num_blocks * bits_per_block - len(message_bits))
+    message_nums = conv.bits_to_nums(message_bits, width=bits_per_block)
+    
+    for i in range(num_blocks):
+        block = lsbs[i * block_size:(i + 1) * block_size]
+        
+        syndrome = 0
+        for index in np.flatnonzero(block):
+            syndrome ^= int(index)
+        
+        block[syndrome ^ message_nums[i]] ^= 1
+    
+    #The numbers past the last block get their low order bits wiped out
+    lsbs[num_blocks * block_size:] = 0
+    
+    result = im_arr.copy()
+    result[:, :, :depth] = np.reshape(numbers - numbers % 2 + lsbs,
+                                      (*im_arr.shape[:2], depth))
+    if has_alpha:
+        result[:, :, -1] = 255
+    
+    return result
+
+def round_trip_test():
+    """
+    Check that every way of encoding gives the same image as slow_encode,
+    and that every way of decoding reads the message back.
+    """
+    rng = np.random.default_rng(0)
+    
+    for mode in ['RGB', 'RGBA']:
+        has_alpha = mode == 'RGBA'
+        im_arr = rng.integers(0, 256, (61, 47, len(mode)), dtype=np.uint8)
+        image = Image.fromarray(im_arr, mode)
+        prepared = PreparedCarrier(image)
+        
+        for block_size in [2, 8, 64]:
+            num_bits = capacity(image.size, tagging.get_depth(image),
+                                block_size)
+            message_bits = rng.integers(0, 2, num_bits - 5, dtype=np.uint8)
+            expected = slow_encode(im_arr, message_bits, block_size,
+                                   has_alpha)
+            
+            encoded = encode_message(image, message_bits, block_size)
+            assert np.array_equal(np.array(encoded), expected)
+            
+            encoded = encode_message(image, message_bits, block_size,
+                                     workers=2)
+            assert np.array_equal(np.array(encoded), expected)
+            
+            encoded = prepared.encode(message_bits, block_size)
+            assert np.array_equal(np.array(encoded), expected)
+            
+            tiled = im_arr.copy()
+            encode_tiled(tiled, message_bits, block_size, band_rows=5,
+                         has_alpha=has_alpha)
+            assert np.array_equal(tiled, expected)
+            
+            #The raw path leaves the alpha channel as it is
+            buffer = bytearray(im_arr.tobytes())
+            raw = as_carrier_array(buffer, im_arr.shape, has_alpha=has_alpha)
+            encode_raw(raw, message_bits, block_size, band_size=1000)
+            assert np.array_equal(raw, get_carrier_array(
+                Image.fromarray(expected, mode)))
+            
+            #Every decoder reads the message back
+            encoded = Image.fromarray(expected, mode)
+            decoded = [decode_message(encoded, block_size),
+                       decode_message(encoded, block_size, workers=2),
+                       decode_tiled(expected, block_size, band_rows=5,
+                                    has_alpha=has_alpha),
+                       decode_raw(raw, block_size, band_size=1000),
+                       bitstream.concatenate(list(iter_decode(
+                           encoded, block_size, chunk_bits=100)))]
+            for bits in decoded:
+                assert np.array_equal(np.asarray(bits)[:len(message_bits)],
+                                      message_bits)
+    
+    print('Round trip passed')
+
+def tagging_round_trip_test():
+    """
+    Check that every type of tagged message is decoded back, with and
+    without compression, at any block size, and that parts of messages
+    and containers are read back on their own.
+    """
+    rng = np.random.default_rng(3)
+    carrier = Image.fromarray(rng.integers(0, 256, (300, 300, 3),
+                                           dtype=np.uint8))
+    original = np.array(carrier)
+    
+    #Fields of every number of segments
+    for field in [0, 7, 8, 2047, 2048, 2**19, 10**9]:
+        bits = bitstream.Bitstream.from_bits(tagging.write_field(field))
+        assert tagging.read_field_at(bits, 0) == (field, len(bits))
+    
+    #A string longer than 2047 characters needs a longer length field
+    long_string = 'In the suburbs I, I learned to drive 水百合. ' * 60
+    image = Image.fromarray(rng.integers(0, 256, (9, 11, 3),
+                                         dtype=np.uint8))
+    messages = ['testing 水百合', long_string, b'\x00\x01\xff' * 300,
+                bytearray(b'bytes'), memoryview(b'abcdefgh')[::2], image]
+    
+    def check(message, decoded):
+        if isinstance(message, Image.Image):
+            assert np.array_equal(np.array(decoded), np.array(message))
+        elif isinstance(message, str):
+            assert decoded == message
+        else:
+            assert decoded == bytes(message)
+    
+    for message in messages:
+        for compression in [None, 'zlib', 'lzma', 'bz2']:
+            encoded = tagging.encode_message(carrier, message,
+                                             compression=compression)
+            check(message, tagging.decode_message(encoded))
+    
+    #The block size is found from the check bits
+    for block_size in [2, 2**5, 2**9]:
+        for prefix_only in [False, True]:
+            encoded = tagging.encode_message(carrier, messages[0], block_size,
+                                             prefix_only=prefix_only)
+            check(messages[0], tagging.decode_message(encoded))
+            check(messages[0], tagging.decode_message(encoded, block_size))
+            
+            #Only the blocks the message needs are touched
+            if prefix_only:
+                num_bits = tagging.get_message_length(messages[0])
+                num_blocks = -(-num_bits // get_bits_per_block(block_size))
+                used = num_blocks * block_size
+                assert np.array_equal(np.array(encoded).flatten()[used:],
+                                      original.flatten()[used:])
+    
+    prepared = PreparedCarrier(carrier)
+    for message in messages:
+        check(message, tagging.decode_message(
+            tagging.encode_message(prepared, message)))
+    
+    #Ranges, cut short at the end of the message
+    encoded = tagging.encode_message(carrier, long_string)
+    for offset, length in [(0, 5), (2040, 20), (len(long_string) - 3, 10)]:
+        part = tagging.read_range(encoded, offset, length)
+        assert part == long_string[offset:offset + length]
+    
+    data = messages[2]
+    encoded = tagging.encode_message(carrier, data, 2**4)
+    assert tagging.read_range(encoded, 123, 45) == data[123:168]
+    
+    encoded = tagging.encode_message(carrier, image)
+    pixels = np.array(image).tobytes()
+    assert tagging.read_range(encoded, 7, 30) == pixels[7:37]
+    
+    #Compressed bits don't line up with the message
+    encoded = tagging.encode_message(carrier, long_string, compression='zlib')
+    try:
+        tagging.read_range(encoded, 0, 5)
+        assert False
+    except ValueError:
+        pass
+    
+    #Containers, read one message at a time
+    encoded = tagging.encode_container(carrier, messages)
+    entries = tagging.list_entries(encoded)
+    assert len(entries) == len(messages)
+    for entry, message in zip(entries, messages):
+        check(message, tagging.extract_entry(encoded, entry.id))
+    
+    encoded, entry_id = tagging.append_entry(encoded, 'one more')
+    assert tagging.extract_entry(encoded, entry_id) == 'one more'
+    check(messages[1], tagging.extract_entry(encoded, 1))
+    
+    print('Tagging round trip passed')
+
+def bitstream_test():
+    """
+    Check the packed Bitstream against plain arrays of bits.
+    """
+    rng = np.random.default_rng(1)
+    bits = rng.integers(0, 2, 1000, dtype=np.uint8)
+    
+    stream = bitstream.Bitstream.from_bits(bits)
+    assert np.array_equal(stream.to_bits(), bits)
+    assert list(stream) == bits.tolist()
+    assert stream[3] == bits[3] and stream[-1] == bits[-1]
+    
+    #Slices at any bit offset, then appending to a slice
+    for start, stop in [(0, 1000), (3, 17), (5, 998), (8, 16), (999, 1000)]:
+        part = stream[start:stop]
+        assert np.array_equal(part.to_bits(), bits[start:stop])
+        
+        part.append(bits[:13])
+        assert np.array_equal(part.to_bits(),
+                              np.concatenate([bits[start:stop], bits[:13]]))
+    assert np.array_equal(stream.to_bits(), bits)
+    
+    #Numbers of any width, padded with zeros at the end
+    for width in [1, 3, 6, 7, 13]:
+        nums = stream.to_nums(width)
+        padded = np.concatenate([bits, np.zeros([-len(bits) % width],
+                                                dtype=np.uint8)])
+        assert nums.tolist() == conv.bits_to_nums(padded, width=width)
+        assert list(stream.iter_nums(width)) == nums.tolist()
+        
+        back = bitstream.Bitstream.from_nums(nums, width)
+        assert np.array_equal(back.to_bits()[:len(bits)], bits)
+    
+    data = stream.tobytes()
+    assert bitstream.Bitstream.from_bytes(data)[:len(bits)] == stream
+    
+    print('Bitstream passed')
+
+def codebook_test():
+    """
+    Check the binary table format and a multi-bit round trip,
+    with the shipped table and with the solver.
+    """
+    import os
+    import tempfile
+    
+    table = cb.load('bitstrings/bitstrings_64_choose_2.bin')
+    assert cb.validate(table)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'table.bin')
+        cb.write_table(path, table)
+        copy = cb.read_table(path)
+        
+        assert copy.width == table.width
+        assert copy.max_flips == table.max_flips
+        assert np.array_equal(copy.entries, table.entries)
+        assert np.array_equal(copy.indices, table.indices)
+        del copy
+    
+    rng = np.random.default_rng(2)
+    image = Image.fromarray(rng.integers(0, 256, (40, 50, 3),
+                                         dtype=np.uint8))
+    
+    solved = cb.Codebook(table.entries, table.width, table.max_flips, None)
+    for codebook in [table, solved]:
+        num_bits = multi_bit_capacity(image.size, 3, codebook)
+        message_bits = rng.integers(0, 2, num_bits, dtype=np.uint8)
+        
+        encoded = encode_multi_bit(image, message_bits, codebook)
+        bits = decode_multi_bit(encoded, codebook)
+        assert np.array_equal(np.asarray(bits), message_bits)
+        
+        #Every block changes by at most max_flips numbers
+        changed = np.array(encoded) != np.array(image)
+        blocks = np.reshape(changed.flatten()[:num_bits // codebook.width
+                                               * len(codebook.entries)],
+                            (-1, len(codebook.entries)))
+        assert blocks.sum(axis=1).max() <= codebook.max_flips
+    
+    print('Codebook passed')
+
 def main():
+    round_trip_test()
+    tagging_round_trip_test()
+    bitstream_test()
+    codebook_test()
+    
     # encode_test()
     # decode_test()
     # detection_test()
@@ -5,12 +5,17 @@ Created on Fri Apr 30 20:34:31 2021
 @author: rober
 """
 
+import bz2
+import collections
+import lzma
 import math
+import zlib
 
 import numpy as np
 
 from PIL import Image
 
+import bitstream
 import conversion as conv
 import steganography as stega
 
@@ -34,49 +39,154 @@ import steganography as stega
 TYPE_STRING_TAG = 0
 TYPE_IMAGE_TAG = 1
 
+# A compressed message holds another message, without its check bits,
+# compressed as bytes. Its fields are the compression method,
+# the number of bits in the message and the number of compressed bytes.
+TYPE_COMPRESSED_TAG = 2
+
+# A bytes message holds raw bytes. Its only field is the number of bytes.
+TYPE_BYTES_TAG = 3
+
+# A container holds any number of messages, without their check bits,
+# one after another. Its fields are the index: the number of messages,
+# then the type, offset and length in bits of each one in the body.
+TYPE_CONTAINER_TAG = 4
+
+# One message of a container
+ContainerEntry = collections.namedtuple('ContainerEntry',
+                                        ['id', 'type', 'offset', 'length'])
+
+COMPRESSION_ZLIB = 0
+COMPRESSION_LZMA = 1
+COMPRESSION_BZ2 = 2
+
+COMPRESSION_FROM_NAME = {'zlib': COMPRESSION_ZLIB,
+                         'lzma': COMPRESSION_LZMA,
+                         'bz2': COMPRESSION_BZ2}
+
 def convert_to_string(fields, bits):
-    length, width = [conv.bits_to_num(b) for b in fields]
-    message = list()
+    length, width = fields
     
-    for i in range(length):
-        char_bits = bits[i*width:(i+1)*width]
-        char_num = conv.bits_to_num(char_bits)
-        char = chr(char_num)
-        message.append(char)
+    #Decode every character at once
+    bits = bitstream.as_bitstream(bits)
+    codes = bits[:length*width].to_nums(width, length)
     
-    return ''.join(message)
+    return conv.nums_to_str(codes)
 
 def convert_to_image(fields, bits):
-    w, h, d, a = [conv.bits_to_num(b) for b in fields]
+    w, h, d, a = fields
     
-    shape = (w, h, d)
+    #The rows of an image are its height
+    shape = (h, w, d)
     
     num_bits = w*h*d*8
-    bits = bits[:num_bits]
+    bits = bitstream.as_bitstream(bits)[:num_bits]
+    
+    im_arr = np.reshape(bits.packed(), shape)
+    
+    if a:
+        im_arr = conv.add_alpha(im_arr, 255)
     
-    return conv.bits_to_image(bits, shape, bool(a))
+    return Image.fromarray(im_arr)
+
+def compress_bytes(data, compression, level=None):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, -1 if level is None else level)
+    if compression == COMPRESSION_LZMA:
+        return lzma.compress(data, preset=level)
+    if compression == COMPRESSION_BZ2:
+        return bz2.compress(data, 9 if level is None else level)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+def decompress_bytes(data, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression == COMPRESSION_LZMA:
+        return lzma.decompress(data)
+    if compression == COMPRESSION_BZ2:
+        return bz2.decompress(data)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+def convert_to_uncompressed(fields, bits):
+    compression, num_bits, num_bytes = fields
+    
+    bits = bitstream.as_bitstream(bits)
+    data = decompress_bytes(bits[:num_bytes*8].tobytes(), compression)
+    
+    #The inner message has its own type and fields
+    inner = bitstream.Bitstream.from_bytes(data)[:num_bits]
+    m_type, fields, position = parse_tag(inner)
+    
+    converter = FROM_BITS_CONVERTER_FROM_TYPE[m_type]
+    return converter(fields, inner[position:])
+
+def convert_to_bytes(fields, bits):
+    length, = fields
+    
+    #Pack the bits straight back into bytes
+    bits = bitstream.as_bitstream(bits)
+    return bits[:length*8].tobytes()
+
+def get_compressed_body_length(fields):
+    _, _, num_bytes = fields
+    return num_bytes * 8
+
+def get_container_entries(fields):
+    """
+    Return the ContainerEntry of each message in a container.
+    """
+    count = fields[0]
+    return [ContainerEntry(i, *fields[1 + 3*i:4 + 3*i]) for i in range(count)]
+
+def convert_to_entry(entry, bits):
+    """
+    Convert one message of a container from the bits of the body.
+    """
+    inner = bits[entry.offset:entry.offset + entry.length]
+    m_type, fields, position = parse_tag(inner)
+    
+    converter = FROM_BITS_CONVERTER_FROM_TYPE[m_type]
+    return converter(fields, inner[position:])
+
+def convert_to_container(fields, bits):
+    bits = bitstream.as_bitstream(bits)
+    return [convert_to_entry(entry, bits)
+            for entry in get_container_entries(fields)]
+
+def get_container_body_length(fields):
+    entries = get_container_entries(fields)
+    if not entries:
+        return 0
+    return entries[-1].offset + entries[-1].length
 
 FROM_BITS_CONVERTER_FROM_TYPE = {TYPE_STRING_TAG: convert_to_string,
-                                 TYPE_IMAGE_TAG: convert_to_image}
+                                 TYPE_IMAGE_TAG: convert_to_image,
+                                 TYPE_COMPRESSED_TAG: convert_to_uncompressed,
+                                 TYPE_BYTES_TAG: convert_to_bytes,
+                                 TYPE_CONTAINER_TAG: convert_to_container}
 
-def convert_from_string(string):
+def get_string_width(string):
     max_ord = max([ord(c) for c in string])
-    
+    return math.ceil(math.log(max_ord, 2))
+
+def get_string_fields(string):
+    return [len(string), get_string_width(string)]
+
+def get_string_body_length(fields):
+    length, width = fields
+    return length * width
+
+def convert_from_string(string):
     m_type = TYPE_STRING_TAG
-    length = len(string)
-    width = math.ceil(math.log(max_ord, 2))
+    length, width = get_string_fields(string)
     
     type_bits = write_field(m_type)
     field_bits = write_fields([length, width])
     
-    str_bits = list()
-    for c in string:
-        c_bits = conv.get_bits(ord(c), width=width)
-        str_bits.extend(c_bits)    
+    str_bits = bitstream.Bitstream.from_nums(conv.str_to_nums(string), width)
     
-    bits = type_bits
-    bits.extend(field_bits)
-    bits.extend(str_bits)
+    bits = bitstream.Bitstream.from_bits(type_bits + field_bits)
+    bits.append(str_bits)
     
     return bits
 
@@ -88,29 +198,186 @@ def get_depth(image):
         return 3
     return len(image.mode)
 
-def convert_from_image(image):
+def get_image_fields(image):
     w, h = image.size
     d = get_depth(image)
     a = image.mode == 'RGBA'
+    return [w, h, d, int(a)]
+
+def get_image_body_length(fields):
+    w, h, d, _ = fields
+    return w*h*d*8
+
+def convert_from_image(image):
+    w, h, d, a = get_image_fields(image)
     
     m_type = TYPE_IMAGE_TAG
     type_bits = write_field(m_type)
-    field_bits = write_fields([w, h, d, int(a)])
+    field_bits = write_fields([w, h, d, a])
+    
+    image_bytes = conv.image_to_bytes(image, bool(a))
+    
+    bits = bitstream.Bitstream.from_bits(type_bits + field_bits)
+    bits.append(bitstream.Bitstream.from_bytes(image_bytes))
+    return bits
+
+def get_bytes_fields(data):
+    return [memoryview(data).nbytes]
+
+def get_bytes_body_length(fields):
+    length, = fields
+    return length * 8
+
+def convert_from_bytes(data):
+    m_type = TYPE_BYTES_TAG
+    type_bits = write_field(m_type)
+    field_bits = write_fields(get_bytes_fields(data))
     
-    image_bits = conv.image_to_bits(image, bool(a))
+    #A strided memoryview can't be viewed as packed bytes,
+    #so it is the one that gets copied first
+    data = memoryview(data)
+    if not data.c_contiguous:
+        data = data.tobytes()
+    
+    #A view of the bytes, copied only once into the message
+    bits = bitstream.Bitstream.from_bits(type_bits + field_bits)
+    bits.append(bitstream.Bitstream.from_bytes(data))
+    return bits
+
+class Container:
+    """
+    Many messages to hide in one carrier together.
+    
+    Each message is converted when it is added,
+    and can be read back on its own without decoding the others.
+    """
+    
+    def __init__(self, messages=()):
+        #The type and the bits, with their tag, of each message
+        self.types = list()
+        self.messages = list()
+        
+        for message in messages:
+            self.append(message)
+    
+    def __len__(self):
+        return len(self.messages)
+    
+    def append(self, message):
+        """
+        Add a message.
+        
+        Returns:
+            int: The id of the message.
+        """
+        m_type = get_message_type(message)
+        converter = TO_BITS_CONVERTER_FROM_TYPE[m_type]
+        
+        return self.append_bits(m_type, converter(message))
+    
+    def append_bits(self, m_type, bits):
+        """
+        Add a message that is already converted, with its tag.
+        """
+        self.types.append(m_type)
+        self.messages.append(bitstream.as_bitstream(bits))
+        return len(self.messages) - 1
+
+def get_container_fields(container):
+    fields = [len(container)]
+    
+    offset = 0
+    for m_type, bits in zip(container.types, container.messages):
+        fields += [m_type, offset, len(bits)]
+        offset += len(bits)
+    
+    return fields
+
+def convert_from_container(container):
+    m_type = TYPE_CONTAINER_TAG
+    type_bits = write_field(m_type)
+    field_bits = write_fields(get_container_fields(container))
+    
+    bits = bitstream.Bitstream.from_bits(type_bits + field_bits)
+    bits.reserve(len(bits) + sum(len(m) for m in container.messages))
+    for message in container.messages:
+        bits.append(message)
     
-    bits = type_bits
-    bits.extend(field_bits)
-    bits.extend(image_bits)
     return bits
 
 TO_BITS_CONVERTER_FROM_TYPE = {TYPE_STRING_TAG: convert_from_string,
-                               TYPE_IMAGE_TAG: convert_from_image}
+                               TYPE_IMAGE_TAG: convert_from_image,
+                               TYPE_BYTES_TAG: convert_from_bytes,
+                               TYPE_CONTAINER_TAG: convert_from_container}
+
+FIELDS_FROM_TYPE = {TYPE_STRING_TAG: get_string_fields,
+                    TYPE_IMAGE_TAG: get_image_fields,
+                    TYPE_BYTES_TAG: get_bytes_fields,
+                    TYPE_CONTAINER_TAG: get_container_fields}
+
+BODY_LENGTH_FROM_TYPE = {TYPE_STRING_TAG: get_string_body_length,
+                         TYPE_IMAGE_TAG: get_image_body_length,
+                         TYPE_COMPRESSED_TAG: get_compressed_body_length,
+                         TYPE_BYTES_TAG: get_bytes_body_length,
+                         TYPE_CONTAINER_TAG: get_container_body_length}
+
+def get_string_unit_length(fields):
+    _, width = fields
+    return width
+
+def get_byte_unit_length(fields):
+    return 8
+
+def convert_to_string_range(fields, bits):
+    _, width = fields
+    return conv.nums_to_str(bits.to_nums(width))
+
+def convert_to_bytes_range(fields, bits):
+    return bits.tobytes()
+
+#The number of bits in each unit of a range, for the types
+#that can be read a range at a time
+UNIT_LENGTH_FROM_TYPE = {TYPE_STRING_TAG: get_string_unit_length,
+                         TYPE_IMAGE_TAG: get_byte_unit_length,
+                         TYPE_BYTES_TAG: get_byte_unit_length}
+
+RANGE_CONVERTER_FROM_TYPE = {TYPE_STRING_TAG: convert_to_string_range,
+                             TYPE_IMAGE_TAG: convert_to_bytes_range,
+                             TYPE_BYTES_TAG: convert_to_bytes_range}
+
+def compress_message(bits, compression='zlib', level=None):
+    """
+    Compress the bits of a converted message into a compressed message.
+    
+    Parameters:
+        bits: The message bits, with their tag but not the check bits.
+        compression: 'zlib', 'lzma' or 'bz2'.
+        level: The compression level. By default, the method's default.
+    
+    Returns:
+        Bitstream: The compressed message, or the given bits
+            if compressing doesn't make them shorter.
+        float: The length of the result over the length of the bits.
+    """
+    bits = bitstream.as_bitstream(bits)
+    compression = COMPRESSION_FROM_NAME[compression]
+    
+    data = compress_bytes(bits.tobytes(), compression, level)
+    fields = [compression, len(bits), len(data)]
+    
+    compressed = write_field(TYPE_COMPRESSED_TAG) + write_fields(fields)
+    compressed = bitstream.Bitstream.from_bits(compressed)
+    compressed.append(bitstream.Bitstream.from_bytes(data))
+    
+    if len(compressed) >= len(bits):
+        return bits, 1.0
+    return compressed, len(compressed) / len(bits)
 
 NUM_CHECK_BITS = 128
 # CHECK_NUM = 15971532633023303877
 CHECK_NUM = 301745980665976028475011311407568552610
 CHECK_BITS = tuple(conv.get_bits(CHECK_NUM, width=NUM_CHECK_BITS))
+CHECK_STREAM = bitstream.Bitstream.from_bits(CHECK_BITS)
 
 FIELD_FIRST_SEGMENT_LENGTH = 3
 FIELD_SEGMENT_LENGTH = 8
@@ -128,28 +395,36 @@ def validate_message(bits):
     Returns:
         bool: Whether the message is a valid message.
     """
-    return bits[:NUM_CHECK_BITS] == list(CHECK_BITS)
+    check_bits = bitstream.as_bitstream(bits[:NUM_CHECK_BITS])
+    return check_bits == CHECK_STREAM
 
-def read_field(i):
+def read_field_at(bits, position):
     """
-    Read a field from the given bit-iterator.
+    Read a field from the packed bits at the given position.
     
     Parameters:
-        i: The iterator over the bits to parse a length-spec from.
+        bits: The Bitstream to read the field from.
+        position: The bit the field starts at.
     
     Returns:
-        [int]: The read field.
+        int: The read field.
+        int: The position just after the field.
     """
-    *bits, c = next(i), next(i), next(i), next(i)
+    field = bits.read_num(position, FIELD_FIRST_SEGMENT_LENGTH)
+    position += FIELD_FIRST_SEGMENT_LENGTH
     
-    if not c:
-        return bits
+    more = bits[position]
+    position += 1
     
-    while True:
-        for _ in range(FIELD_SEGMENT_LENGTH):
-            bits.append(next(i))
-        if not next(i):
-            return bits
+    #Each segment is followed by its continuing bit
+    while more:
+        segment = bits.read_num(position, FIELD_SEGMENT_LENGTH + 1)
+        position += FIELD_SEGMENT_LENGTH + 1
+        
+        field = (field << FIELD_SEGMENT_LENGTH) | (segment >> 1)
+        more = segment & 1
+    
+    return field, position
 
 def write_field(field):
     """
@@ -181,7 +456,7 @@ def write_field(field):
     mid_bits = mid_bits[FIELD_FIRST_SEGMENT_LENGTH:]
     
     for i in range(num_sections):
-        s_bits = mid_bits[:FIELD_SEGMENT_LENGTH]
+        s_bits = mid_bits[i*FIELD_SEGMENT_LENGTH:(i+1)*FIELD_SEGMENT_LENGTH]
         result.extend(s_bits)
         
         if i == num_sections - 1:
@@ -209,34 +484,217 @@ def parse_message(bits):
     Parse the message bits into the fields contained in the tag
     and the message itself.
     
+    Only the tag is read, so this takes the same time
+    however long the message is.
+    
     Parameters:
         bits: The bits of the message to parse.
     
     Returns:
         int: The type field.
-        [[int]]: The format fields.
-        [int]: The message bits, not including the tag.
+        [int]: The format fields.
+        Bitstream: The message bits, not including the tag.
+            They share the buffer of the given bits.
     """
+    bits = bitstream.as_bitstream(bits)
     
     #Validate the message
     if not validate_message(bits):
         raise CheckBitsError()
-        
-    bits = bits[NUM_CHECK_BITS:]
     
-    b_iter = iter(bits)
+    m_format, fields, position = parse_tag(bits, NUM_CHECK_BITS)
+    return m_format, fields, bits[position:]
+
+def parse_tag(bits, position=0):
+    """
+    Read the type and format fields of a tag, without check bits.
+    
+    Parameters:
+        bits: The Bitstream holding the tag.
+        position: The bit the tag starts at.
     
-    m_format = conv.bits_to_num(read_field(b_iter))
+    Returns:
+        int: The type field.
+        [int]: The format fields.
+        int: The position just after the tag.
+    """
+    m_format, position = read_field_at(bits, position)
     
     fields = list()
     
     while True:
         #We've come to the end of the list of fields
-        if not next(b_iter):
-            fields.append(read_field(b_iter))
-            return m_format, fields, list(b_iter)
+        last = not bits[position]
         
-        fields.append(read_field(b_iter))
+        field, position = read_field_at(bits, position + 1)
+        fields.append(field)
+        
+        if last:
+            return m_format, fields, position
+
+def find_block_size(im_arr):
+    """
+    Find the block size of the message hidden in the image array.
+    
+    Only the blocks holding the check bits are decoded for each
+    candidate block size, from the biggest down.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+    
+    Returns:
+        int: The block size.
+    """
+    i = math.floor(math.log(im_arr.size, 2))
+    
+    while i >= 1:
+        #Keep going until the check bits match
+        block_size = 2**i
+        num_blocks = math.ceil(NUM_CHECK_BITS / i)
+        i -= 1
+        
+        try:
+            bits = stega.extract_blocks(im_arr, block_size,
+                                        num_blocks=num_blocks)
+        except ValueError:
+            #The check bits don't fit with this block size
+            continue
+        
+        if validate_message(bits):
+            return block_size
+    
+    raise CheckBitsError()
+
+#How many bits to decode at first, to read the check bits and the tag
+HEADER_BITS = 256
+
+def read_tag(im_arr, block_size):
+    """
+    Decode the blocks of the image array until the tag can be read.
+    
+    The first HEADER_BITS bits are decoded first, and then twice as many
+    each time the tag goes on past them, like for a long container index.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        block_size: The size of the blocks.
+    
+    Returns:
+        Bitstream: The bits decoded so far.
+        int: The type of the message.
+        [int]: The format fields.
+        int: The position of the body.
+    """
+    bits = bitstream.Bitstream()
+    
+    for chunk in stega.iter_extract(im_arr, block_size, HEADER_BITS,
+                                    grow=True):
+        bits.append(chunk)
+        
+        if len(bits) >= NUM_CHECK_BITS and not validate_message(bits):
+            raise CheckBitsError()
+        
+        try:
+            m_type, fields, position = parse_tag(bits, NUM_CHECK_BITS)
+        except IndexError:
+            #The tag goes on past these blocks
+            continue
+        
+        return bits, m_type, fields, position
+    
+    raise CheckBitsError()
+
+def read_bits(im_arr, block_size, start, stop, bits=None):
+    """
+    Decode the bits from start to stop of the message,
+    from just the blocks that hold them.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        block_size: The size of the blocks.
+        start: The first bit.
+        stop: The bit after the last.
+        bits: The bits already decoded from the start of the message.
+    
+    Returns:
+        Bitstream: The bits.
+    """
+    if bits is not None and stop <= len(bits):
+        return bits[start:stop]
+    
+    bits_per_block = stega.get_bits_per_block(block_size)
+    first_block = start // bits_per_block
+    num_blocks = -(-stop // bits_per_block) - first_block
+    
+    blocks = stega.extract_blocks(im_arr, block_size, first_block, num_blocks)
+    first_bit = first_block * bits_per_block
+    
+    return blocks[start - first_bit:stop - first_bit]
+
+def read_message_bits(im_arr, block_size):
+    """
+    Decode the bits of the message hidden in the image array, and no more.
+    
+    The blocks are decoded until the tag can be read,
+    then just the blocks the rest of the message needs.
+    
+    Parameters:
+        im_arr: The numbers that carry the message.
+        block_size: The size of the blocks.
+    
+    Returns:
+        Bitstream: The bits of the message, from the check bits
+            to the end of the body.
+    """
+    bits, m_type, fields, position = read_tag(im_arr, block_size)
+    num_bits = position + BODY_LENGTH_FROM_TYPE[m_type](fields)
+    
+    if num_bits > len(bits):
+        bits.append(read_bits(im_arr, block_size, len(bits), num_bits))
+    
+    return bits[:num_bits]
+
+def read_range(image, offset, length, block_size=None):
+    """
+    Decode part of the message hidden in the image, from just the blocks
+    that hold it.
+    
+    Parameters:
+        image: The image with the hidden message.
+        offset: Where the part starts. For a string this counts
+            characters. For bytes or an image it counts bytes,
+            and an image is its pixels as (height, width, depth) bytes
+            without the alpha channel.
+        length: How long the part is, in the same units.
+            It is cut short at the end of the message.
+        block_size: The size of the blocks. By default, it is found
+            from the check bits.
+    
+    Returns:
+        str or bytes: The part of the message.
+    """
+    if offset < 0 or length < 0:
+        raise ValueError('Bad range: {}, {}'.format(offset, length))
+    
+    im_arr = stega.get_carrier_array(image)
+    
+    if block_size is None:
+        block_size = find_block_size(im_arr)
+    
+    bits, m_type, fields, position = read_tag(im_arr, block_size)
+    
+    if m_type not in RANGE_CONVERTER_FROM_TYPE:
+        raise ValueError("Can't read a range of a message of type {}".format(
+            m_type))
+    
+    unit = UNIT_LENGTH_FROM_TYPE[m_type](fields)
+    body_length = BODY_LENGTH_FROM_TYPE[m_type](fields)
+    
+    start = position + min(offset * unit, body_length)
+    stop = position + min((offset + length) * unit, body_length)
+    
+    range_bits = read_bits(im_arr, block_size, start, stop, bits)
+    return RANGE_CONVERTER_FROM_TYPE[m_type](fields, range_bits)
 
 def decode_message(image, block_size=None):
     """
@@ -244,80 +702,278 @@ def decode_message(image, block_size=None):
     
     Parameters:
         image: The image with the hidden message.
-        block_size: The size of the blocks.
+        block_size: The size of the blocks. By default, it is found
+            from the check bits.
     
     Returns:
         The hidden message.
     """
+    im_arr = stega.get_carrier_array(image)
+    
     if block_size is None:
-        w, h = image.size
-        d = 3 #An estimate
-        num_bits = w*h*d
-        
-        i = math.floor(math.log(num_bits, 2))
-        
-        # i = 1
-        while i >= 1:
-            #Keep going until the check bits match
-            #or the block size is bigger than the image
-            block_size = 2**i
-            # print('Block size: {}'.format(block_size))
-            try:
-                bits = stega.decode_message(image, block_size=block_size)
-                
-                m_type, fields, bits = parse_message(bits)
-                converter = FROM_BITS_CONVERTER_FROM_TYPE[m_type]
-                return converter(fields, bits)
-            
-            except ValueError:
-                i -= 1
-                continue
-            except CheckBitsError:
-                i -= 1
-                continue
-        
-        return converter(fields, bits)
+        block_size = find_block_size(im_arr)
     
-    bits = stega.decode_message(image, block_size=block_size)
+    bits = read_message_bits(im_arr, block_size)
     
     m_type, fields, bits = parse_message(bits)
     converter = FROM_BITS_CONVERTER_FROM_TYPE[m_type]
     
     return converter(fields, bits)
 
-def encode_message(carrier, message, block_size=None):
-    m_type = None
-    
+def get_message_type(message):
     if isinstance(message, str):
-        m_type = TYPE_STRING_TAG
-    elif isinstance(message, Image.Image):
-        m_type = TYPE_IMAGE_TAG
+        return TYPE_STRING_TAG
+    if isinstance(message, Image.Image):
+        return TYPE_IMAGE_TAG
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return TYPE_BYTES_TAG
+    if isinstance(message, Container):
+        return TYPE_CONTAINER_TAG
+    raise TypeError('Unsupported message: {}'.format(type(message)))
+
+def get_message_length(message):
+    """
+    Return the number of bits the message takes up with its tag,
+    without converting it.
+    
+    Parameters:
+        message: The message to measure.
+    
+    Returns:
+        int: The number of bits.
+    """
+    m_type = get_message_type(message)
+    fields = FIELDS_FROM_TYPE[m_type](message)
+    
+    tag_length = len(write_field(m_type)) + len(write_fields(fields))
+    body_length = BODY_LENGTH_FROM_TYPE[m_type](fields)
+    
+    return NUM_CHECK_BITS + tag_length + body_length
+
+def get_dimensions(carrier):
+    """
+    Return the size and depth of a carrier.
+    
+    Parameters:
+        carrier: An image, a steganography.PreparedCarrier,
+            or a (width, height, depth) tuple.
+            Image.open doesn't read the pixels, so an opened file is fine.
+    
+    Returns:
+        (int, int): The width and height.
+        int: The number of channels that carry the message.
+    """
+    if isinstance(carrier, Image.Image):
+        return carrier.size, get_depth(carrier)
+    if isinstance(carrier, stega.PreparedCarrier):
+        return carrier.size, carrier.depth
+    
+    w, h, d = carrier
+    return (w, h), d
+
+def best_block_size(payload_bits, carrier):
+    """
+    Return the largest block size whose capacity holds the payload.
+    
+    Only the dimensions of the carrier are used, so this is instant.
+    
+    Parameters:
+        payload_bits: The number of bits to hide, including the tag.
+        carrier: An image, or a (width, height, depth) tuple.
+    
+    Returns:
+        int: The block size.
+    """
+    carrier_size, depth = get_dimensions(carrier)
+    w, h = carrier_size
+    
+    num_bits = stega.capacity(carrier_size, depth, 2)
+    if num_bits < payload_bits:
+        raise ValueError('Message too long: {} - {}'.format(
+            payload_bits, num_bits))
+    
+    #Keep doubling while the bigger blocks still hold the payload
+    block_size = 2
+    while 2 * block_size <= w*h*depth:
+        if stega.capacity(carrier_size, depth, 2 * block_size) < payload_bits:
+            break
+        block_size *= 2
+    
+    return block_size
+
+def encode_message(carrier, message, block_size=None, compression=None,
+                   level=None, stats=None, costs=None, reference=None,
+                   prefix_only=True):
+    """
+    Encode the message into the carrier, with its tag.
+    
+    Parameters:
+        carrier: The image to hide the message in, or a
+            steganography.PreparedCarrier to encode many messages
+            into the same image quickly.
+        message: The string, image or bytes to hide.
+        block_size: The size of the blocks. By default, the largest
+            that fits the message.
+        compression: 'zlib', 'lzma' or 'bz2' to compress the message
+            first. It is only kept if it makes the message shorter.
+        level: The compression level.
+        stats: A dict to fill in with the number of bits of the message
+            before and after compressing and their ratio.
+        costs: The cost map for steganography.encode_message,
+            to make the cheapest change in each block.
+        reference: The values the carrier numbers should be close to,
+            for steganography.encode_message.
+        prefix_only: Whether to leave the carrier past the end of the
+            message as it is. The tag holds the length of the message,
+            so it doesn't need padding to the end of the carrier.
+    
+    Returns:
+        Image: The carrier with the hidden message.
+    """
+    m_type = get_message_type(message)
+    
+    #A compressed container has to be decoded whole,
+    #so its messages couldn't be read on their own
+    if m_type == TYPE_CONTAINER_TAG and compression is not None:
+        raise ValueError("Containers can't be compressed")
+    
+    #Without compression, the size is known before converting anything
+    if block_size is None and compression is None:
+        best_block_size(get_message_length(message), carrier)
     
-    check_bits = list(CHECK_BITS)
     converter = TO_BITS_CONVERTER_FROM_TYPE[m_type]
     rest_bits = converter(message)
+    raw_bits = len(rest_bits)
+    
+    ratio = 1.0
+    if compression is not None:
+        rest_bits, ratio = compress_message(rest_bits, compression, level)
     
-    bits = check_bits + rest_bits
-    bits = np.array(bits, dtype=np.uint8)
+    if stats is not None:
+        stats.update({'raw_bits': raw_bits,
+                      'compressed_bits': len(rest_bits),
+                      'ratio': ratio})
     
     #If the block size is unspecified,
     #choose the largest size that will work
     if block_size is None:
-        w, h = carrier.size
-        d = get_depth(carrier)
-        num_bits = w*h*d
-        
-        num_message_bits = len(bits)
-        block_power = 1
-        prev_block_power = block_power
-        capacity = (num_bits // (2** block_power)) * block_power
-        
-        while capacity >= num_message_bits:
-            prev_block_power = block_power
-            block_power += 1
-            capacity = (num_bits // (2** block_power)) * block_power
-        
-        block_size = 2 ** prev_block_power
+        block_size = best_block_size(NUM_CHECK_BITS + len(rest_bits), carrier)
+    
+    bits = bitstream.Bitstream.from_bits(CHECK_BITS)
+    bits.append(rest_bits)
+    
+    if isinstance(carrier, stega.PreparedCarrier):
+        return carrier.encode(bits, block_size, costs=costs,
+                              reference=reference, prefix_only=prefix_only)
+    
+    return stega.encode_message(carrier, bits, block_size=block_size,
+                                costs=costs, reference=reference,
+                                prefix_only=prefix_only)
+
+def encode_container(carrier, messages, block_size=None, **kwargs):
+    """
+    Encode many messages into the carrier as one container.
+    
+    Parameters:
+        carrier: The image to hide the messages in.
+        messages: The messages, or a Container.
+        block_size: The size of the blocks. By default, the largest
+            that fits the container.
+        kwargs: The other arguments of encode_message, but compression.
+    
+    Returns:
+        Image: The carrier with the hidden container.
+    """
+    if not isinstance(messages, Container):
+        messages = Container(messages)
+    return encode_message(carrier, messages, block_size, **kwargs)
+
+def read_container_tag(image, block_size=None):
+    """
+    Read the tag of the container hidden in the image.
+    
+    Returns:
+        ndarray: The numbers that carry the container.
+        int: The block size.
+        Bitstream: The bits decoded so far.
+        [int]: The fields of the container.
+        int: The position of the body.
+    """
+    im_arr = stega.get_carrier_array(image)
+    
+    if block_size is None:
+        block_size = find_block_size(im_arr)
+    
+    bits, m_type, fields, position = read_tag(im_arr, block_size)
+    if m_type != TYPE_CONTAINER_TAG:
+        raise ValueError('Not a container: type {}'.format(m_type))
+    
+    return im_arr, block_size, bits, fields, position
+
+def list_entries(image, block_size=None):
+    """
+    List the messages in the container hidden in the image,
+    from its index alone.
+    
+    Returns:
+        [ContainerEntry]: The id, type, offset and length in bits
+            of each message.
+    """
+    _, _, _, fields, _ = read_container_tag(image, block_size)
+    return get_container_entries(fields)
+
+def extract_entry(image, entry_id, block_size=None):
+    """
+    Decode one message from the container hidden in the image,
+    from just the blocks that hold it.
+    
+    Parameters:
+        image: The image with the hidden container.
+        entry_id: The id of the message.
+        block_size: The size of the blocks. By default, it is found
+            from the check bits.
+    
+    Returns:
+        The message.
+    """
+    im_arr, block_size, bits, fields, position = read_container_tag(
+        image, block_size)
+    entry = get_container_entries(fields)[entry_id]
+    
+    start = position + entry.offset
+    inner = read_bits(im_arr, block_size, start, start + entry.length, bits)
+    
+    return convert_to_entry(entry._replace(offset=0), inner)
+
+def append_entry(image, message, block_size=None, **kwargs):
+    """
+    Add a message to the container hidden in the image.
+    
+    The other messages are copied as bits, without being converted.
+    The container is encoded again with the same block size,
+    so it has to still fit.
+    
+    Parameters:
+        image: The image with the hidden container.
+        message: The message to add.
+        block_size: The size of the blocks. By default, it is found
+            from the check bits.
+        kwargs: The other arguments of encode_message, but compression.
+    
+    Returns:
+        Image: The image with the bigger container.
+        int: The id of the new message.
+    """
+    im_arr, block_size, bits, fields, position = read_container_tag(
+        image, block_size)
+    
+    num_bits = position + get_container_body_length(fields)
+    body = read_bits(im_arr, block_size, position, num_bits, bits)
     
+    container = Container()
+    for entry in get_container_entries(fields):
+        container.append_bits(entry.type,
+                              body[entry.offset:entry.offset + entry.length])
+    entry_id = container.append(message)
     
-    return stega.encode_message(carrier, bits, block_size=block_size)
+    return encode_container(image, container, block_size, **kwargs), entry_id